@@ -74,6 +74,7 @@ def sendCameraSettings(camera):
     z.capability[camera.name+".angle"]['value'] = angle
     z.capability[camera.name+".shift_x"]['value'] = lx
     z.capability[camera.name+".shift_y"]['value'] = ly       
+    z.invalidate_capability()
 
     camSettings[camera.name] = (angle, lx, ly)
      
@@ -147,51 +148,51 @@ class BpyZOCP(ZOCP):
                     self._register_mesh(obj)
 
     def _register_lamp(self, obj):
-        self.set_object(obj.name, "BPY_Lamp")
-        self.register_vec3f("location",           obj.location[:],         're')
-        #self.register_mat3f("worldOrientation",   obj.worldOrientation[:], 're')
-        self.register_vec3f("orientation",        obj.rotation_euler[:],   're')
-        self.register_vec3f("scale",              obj.scale[:],            're')
-        self.register_vec3f("color",              obj.data.color[:],       're')
-        self.register_float("energy",             obj.data.energy,         're')
-        self.register_float("distance",           obj.data.distance,       're')
-        #self.register_int  ("state",              obj.state)
-        #self.register_float("mass",               obj.mass)
+        # all variables of the object are published in a single MOD
+        self.set_object(obj.name, "BPY_Lamp", params=[
+            {'name': "location",    'value': obj.location[:],       'typeHint': 'vec3f', 'access': 're'},
+            #{'name': "worldOrientation", 'value': obj.worldOrientation[:], 'typeHint': 'mat3f', 'access': 're'},
+            {'name': "orientation", 'value': obj.rotation_euler[:], 'typeHint': 'vec3f', 'access': 're'},
+            {'name': "scale",       'value': obj.scale[:],          'typeHint': 'vec3f', 'access': 're'},
+            {'name': "color",       'value': obj.data.color[:],     'typeHint': 'vec3f', 'access': 're'},
+            {'name': "energy",      'value': obj.data.energy,       'typeHint': 'flt',   'access': 're'},
+            {'name': "distance",    'value': obj.data.distance,     'typeHint': 'flt',   'access': 're'},
+        ])
 
     def _register_camera(self, obj):
-        self.set_object(obj.name, "BPY_Camera")
-        self.register_vec3f("location",           obj.location[:],          're')
-        #self.register_mat3f("worldOrientation",   obj.worldOrientation[:], 're')
-        self.register_vec3f("orientation",        obj.rotation_euler[:],    're')
-        self.register_float("angle",              obj.data.angle,           're')
-        self.register_float("shift_x",            obj.data.shift_x,         're')
-        self.register_float("shift_y",            obj.data.shift_y,         're')
+        self.set_object(obj.name, "BPY_Camera", params=[
+            {'name': "location",    'value': obj.location[:],       'typeHint': 'vec3f', 'access': 're'},
+            {'name': "orientation", 'value': obj.rotation_euler[:], 'typeHint': 'vec3f', 'access': 're'},
+            {'name': "angle",       'value': obj.data.angle,        'typeHint': 'flt',   'access': 're'},
+            {'name': "shift_x",     'value': obj.data.shift_x,      'typeHint': 'flt',   'access': 're'},
+            {'name': "shift_y",     'value': obj.data.shift_y,      'typeHint': 'flt',   'access': 're'},
+        ])
 
     def _register_mesh(self, obj):
-        self.set_object(obj.name, "BPY_Mesh")
-        self.register_vec3f("location",           obj.location[:],          're')
-        #self.register_mat3f("worldOrientation",   obj.worldOrientation[:], 're')
-        self.register_vec3f("orientation",        obj.rotation_euler[:],    're')
-        self.register_vec3f("scale",              obj.scale[:],             're')
-        self.register_vec4f("color",              obj.color[:],             're')
-        #self.register_int  ("state",              obj.state,               're')
-        #self.register_float("mass",               obj.mass,                're')
+        self.set_object(obj.name, "BPY_Mesh", params=[
+            {'name': "location",    'value': obj.location[:],       'typeHint': 'vec3f', 'access': 're'},
+            {'name': "orientation", 'value': obj.rotation_euler[:], 'typeHint': 'vec3f', 'access': 're'},
+            {'name': "scale",       'value': obj.scale[:],          'typeHint': 'vec3f', 'access': 're'},
+            {'name': "color",       'value': obj.color[:],          'typeHint': 'vec4f', 'access': 're'},
+        ])
 
     def send_object_changes(self, obj):
         self.set_object(obj.name, "BPY_Mesh")
+        # changed emitters are signalled in a single batch
+        signals = {}
         if self._cur_obj.get("location", {}).get("value") != obj.location[:]:
             #self.register_vec3f("location", obj.location[:])
-            self.emit_signal("location", obj.location[:])
+            signals["location"] = obj.location[:]
         if self._cur_obj.get("orientation", {}).get("value") != obj.rotation_euler[:]:
             #self.register_vec3f("orientation", obj.rotation_euler[:])
-            self.emit_signal("orientation", obj.rotation_euler[:])
+            signals["orientation"] = obj.rotation_euler[:]
         if self._cur_obj.get("scale", {}).get("value") != obj.scale[:]:
             #self.register_vec3f("scale", obj.scale[:])
-            self.emit_signal("scale", obj.scale[:])
+            signals["scale"] = obj.scale[:]
         if obj.type == "LAMP":
             if self._cur_obj.get("color", {}).get("value") != obj.data.color[:]:
                 #self.register_vec3f("color", obj.data.color[:])
-                self.emit_signal("color", obj.data.color[:])
+                signals["color"] = obj.data.color[:]
             if self._cur_obj.get("energy", {}).get("value") != obj.data.energy[:]:
                 self.register_float("energy", obj.data.energy[:])
             if self._cur_obj.get("distance", {}).get("value") != obj.data.distance[:]:
@@ -201,10 +202,16 @@ class BpyZOCP(ZOCP):
                 self.register_vec4f("color", obj.color[:])
         elif obj.type == "CAMERA":
             self._register_camera(obj)
+        if signals:
+            self.emit_signals(signals)
 
     def emit_signal(self, name, data):
         super().emit_signal(".".join(self._cur_obj_keys + (name, )), data)
 
+    def emit_signals(self, signals):
+        prefix = ".".join(self._cur_obj_keys + ("", ))
+        super().emit_signals(dict((prefix + name, data) for name, data in signals.items()))
+
     #########################################
     # Event methods. These can be overwritten
     #########################################
@@ -326,7 +333,7 @@ def scene_update(context):
     # only once per 'toffset' seconds to lessen the burden
     if time.time() > tstamp + toffset:
         tstamp = time.time()
-        z.run_once(timeout=0)
+        z.run_once(timeout=0, max_time_ms=5)
         update_objects()
     #else:
     #    print("delayed", tstamp, time.time())
@@ -11,9 +11,15 @@ z = ZOCP("GLibTest")
 z.register_percent('myPercent', 12, access='rw')
 
 def zocp_handle(*args, **kwargs):
-    z.run_once()
+    # handle a bounded amount of messages to keep the UI responsive,
+    # continue when idle if more are waiting
+    if z.run_once(0, max_time_ms=10):
+        GObject.idle_add(zocp_idle)
     return True
 
+def zocp_idle():
+    return z.run_once(0, max_time_ms=10)
+
 GObject.io_add_watch(
         z.inbox.getsockopt(zmq.FD), 
         GObject.PRIORITY_DEFAULT, 
@@ -13,8 +13,7 @@ except ImportError:
     from PySide.QtCore import QSocketNotifier
     from PySide.QtGui import QWidget, QTextEdit, QApplication
 
-from zocp import ZOCP
-import zmq
+from threadedzocp import ThreadedZOCP
 
 class QTZOCPNode(QWidget):
 
@@ -27,10 +26,12 @@ class QTZOCPNode(QWidget):
         self.show()
 
     def init_zocp(self):
-        self.z = ZOCP("QT UI TEST")
+        # all network traffic is handled on a background thread, the UI
+        # thread only runs the event callbacks
+        self.z = ThreadedZOCP("QT UI TEST")
         self.z.register_float("myFloat", 2.3, 'rw', 0, 5.0, 0.1)
         self.notifier = QSocketNotifier(
-                self.z.inbox.getsockopt(zmq.FD), 
+                self.z.fileno(),
                 QSocketNotifier.Read
                 )
         self.notifier.setEnabled(True)
@@ -40,7 +41,7 @@ class QTZOCPNode(QWidget):
 
     def zocp_event(self):
         print("ZOCP EVENT START")
-        self.z.run_once(0)
+        self.z.process_events()
         print("ZOCP EVENT END")
 
     def on_modified(self, peer, name, data, *args, **kwargs):
@@ -3,7 +3,6 @@
 from zocp import ZOCP
 import socket
 import logging
-import time
 
 class SubscribableNode(ZOCP):
     # Constructor
@@ -14,7 +13,7 @@ class SubscribableNode(ZOCP):
         self.counter_active = False
         self.string_value = ''
         self.interval = 1.0
-        self.loop_time = 0
+        self.timer = None
 
 
     def run(self):
@@ -24,16 +23,13 @@ class SubscribableNode(ZOCP):
         self.register_float("Interval", self.interval, 'rw', .01, 10, 0.1)
         self.register_string("My String", self.string_value, 'rwe')
         self.start()
+        super(SubscribableNode, self).run()
 
-        while True:
-            try:
-                self.run_once(0)
-                if self.counter_active and time.time() > self.loop_time:
-                    self.loop_time = time.time() + self.interval
-                    self.on_timer()
-            except (KeyboardInterrupt, SystemExit):
-                self.stop()
-                break
+
+    def start_timer(self):
+        if self.timer:
+            self.timer.cancel()
+        self.timer = self.call_every(self.interval, self.on_timer)
 
 
     def on_modified(self, peer, name, data, *args, **kwargs):
@@ -62,14 +58,15 @@ class SubscribableNode(ZOCP):
         if key == "Interval":
             if new_value != self.interval:
                 self.interval = new_value
-                new_loop = time.time() + self.interval
-                if new_loop < self.loop_time:
-                    self.loop_time = new_loop
+                if self.counter_active:
+                    self.start_timer()
         if key == "Counter active":
             if new_value != self.counter_active:
                 self.counter_active = new_value
                 if new_value:
-                    self.loop_time = time.time() + self.interval
+                    self.start_timer()
+                elif self.timer:
+                    self.timer.cancel()
 
 
     def on_timer(self):
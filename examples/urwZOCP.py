@@ -24,6 +24,10 @@ import zmq
 import time
 import zocp
 import errno
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
 
 # http://stackoverflow.com/questions/38987/how-can-i-merge-union-two-python-dictionaries-in-a-single-expression?rq=1
 def mergedicts(a, b, path=None):
@@ -33,7 +37,7 @@ def mergedicts(a, b, path=None):
     if path is None: path = []
     for key in b:
         if key in a:
-            if isinstance(a[key], dict) and isinstance(b[key], dict):
+            if isinstance(a[key], Mapping) and isinstance(b[key], Mapping):
                 mergedicts(a[key], b[key], path + [str(key)])
             else:
                 a[key] = b[key]
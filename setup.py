@@ -1,5 +1,11 @@
+import sys
 from distutils.core import setup
 
+requires = ['pyre']
+if sys.version_info < (3, 2):
+    # backport of concurrent.futures
+    requires.append('futures')
+
 setup(name='pyZOCP',
       version='0.1',
       description='Python ZOCP implementation',
@@ -9,5 +15,5 @@ setup(name='pyZOCP',
       packages=['zocp'],
       package_dir = {'zocp': 'src'},
       include_package_data=True,
-      requires=['pyre']
+      requires=requires
      )
@@ -0,0 +1,148 @@
+# Z25 Orchestror Control Protocol
+# Copyright (c) 2013, Stichting z25.org, All rights reserved.
+# Copyright (c) 2013, Arnaud Loonstra, All rights reserved.
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3.0 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library.
+
+import asyncio
+import concurrent.futures
+import zmq
+import zmq.asyncio
+import logging
+
+from zocp import ZOCP
+
+logger = logging.getLogger(__name__)
+
+class AsyncZOCP(ZOCP):
+    """
+    A ZOCP node running its receive loop as an asyncio task
+
+    The same on_peer_* methods are called as for a ZOCP node. Multiple
+    nodes and other I/O can share one event loop without polling.
+
+    :param str name: Name of the node, if not given a random name will be created
+    :param int max_messages: maximum number of messages handled before\
+                yielding to other tasks
+    """
+    def __init__(self, *args, **kwargs):
+        max_messages = kwargs.pop('max_messages', 100)
+        self._task = None
+        super(AsyncZOCP, self).__init__(*args, **kwargs)
+        self.max_messages = max_messages
+        self._apoller = zmq.asyncio.Poller()
+        self._apoller.register(self.inbox, zmq.POLLIN)
+        self._apoller.register(self._wakeup, zmq.POLLIN)
+
+    def start_async(self):
+        """
+        Start the node and run its receive loop as a task on the
+        current event loop
+
+        :return: the asyncio task running the loop
+        """
+        self.start()
+        self._task = asyncio.ensure_future(self.run_async())
+        return self._task
+
+    async def run_async(self):
+        """
+        Run the ZOCP loop until the node is stopped
+        """
+        self._running = True
+        while self._running:
+            timeout = self._get_timeout(None)
+            await self._apoller.poll(-1 if timeout is None else timeout)
+            # handle a bounded batch, then give other tasks a turn
+            while self.run_once(0, max_messages=self.max_messages):
+                await asyncio.sleep(0)
+
+    def _schedule(self, timer):
+        # other tasks add timers while the loop waits for a later
+        # deadline, wake it up to wait for the new one
+        if self._task is not None and (not self._timers or timer.deadline < self._timers[0][0]):
+            try:
+                self._wakeup_pipe.send(b'', zmq.NOBLOCK)
+            except zmq.Again:
+                # the loop is already woken up
+                pass
+        return super(AsyncZOCP, self)._schedule(timer)
+
+    def stop(self):
+        """
+        Stop the receive loop and the node
+        """
+        self._running = False
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        super(AsyncZOCP, self).stop()
+
+    #########################################
+    # Awaitable node methods to peers
+    #########################################
+    async def peer_get_async(self, peer, keys=None, timeout=None):
+        """
+        Get items from peer and wait for the reply
+
+        :param uuid peer: the id of the peer
+        :param list keys: names of the items to get, or None to get\
+                    the complete capability
+        :param float timeout: seconds to wait before raising\
+                    asyncio.TimeoutError
+        :return: the requested part of the peer's capability
+        """
+        # the node expires the request itself, so it is not left pending
+        return await _await_request(self.peer_get(peer, keys, timeout=timeout))
+
+    async def peer_set_async(self, peer, data, timeout=None):
+        """
+        Set items on peer and wait until the new values can be read back
+
+        :param uuid peer: the id of the peer
+        :param dict data: the items to set
+        :param float timeout: seconds to wait before raising\
+                    asyncio.TimeoutError
+        :return: the items as stored on the peer
+        """
+        await _await_request(self.peer_set(peer, data, timeout=timeout))
+        return await self.peer_get_async(peer, list(data.keys()), timeout)
+
+    async def signal_subscribe_async(self, recv_peer, receiver, emit_peer, emitter, timeout=None):
+        """
+        Subscribe a receiver to an emitter and wait until the emitting
+        peer has handled the subscription
+
+        See signal_subscribe for the arguments.
+
+        :return: the emitter on the emitting peer, or its complete\
+                capability if emitter is None
+        """
+        self.signal_subscribe(recv_peer, receiver, emit_peer, emitter)
+        if emit_peer == self.uuid():
+            return self.capability if emitter is None else self._params[emitter]
+        keys = None if emitter is None else [emitter]
+        reply = await self.peer_get_async(emit_peer, keys, timeout)
+        return reply if emitter is None else reply.get(emitter)
+
+
+async def _await_request(future):
+    """
+    Await the future of a node request, raising asyncio.TimeoutError
+    when the request expired
+    """
+    try:
+        return await asyncio.wrap_future(future)
+    except concurrent.futures.TimeoutError:
+        raise asyncio.TimeoutError()
@@ -0,0 +1,347 @@
+# Z25 Orchestror Control Protocol
+# Copyright (c) 2013, Stichting z25.org, All rights reserved.
+# Copyright (c) 2013, Arnaud Loonstra, All rights reserved.
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3.0 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library.
+
+import os
+import errno
+import fcntl
+import threading
+import collections
+import concurrent.futures
+import logging
+
+from zocp import ZOCP
+
+logger = logging.getLogger(__name__)
+
+def _set_nonblocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+class ThreadedZOCP(ZOCP):
+    """
+    A ZOCP node doing all socket work on a background I/O thread
+
+    Methods sending to peers or changing the capability can be called
+    from any thread, they are queued to the I/O thread. Methods querying
+    the node's peers are run on the I/O thread too, waiting for their
+    result, so only the I/O thread uses the sockets. The on_* event
+    methods are queued to the application, which calls process_events
+    when the file descriptor returned by fileno becomes readable, or
+    just periodically.
+
+    :param str name: Name of the node, if not given a random name will be created
+    """
+    def __init__(self, *args, **kwargs):
+        self._thread = None
+        super(ThreadedZOCP, self).__init__(*args, **kwargs)
+        # the id and name are asked from the actor once and then cached
+        self.uuid()
+        self.name()
+        # events are appended by the I/O thread and popped by the
+        # application, deque appends and pops are atomic
+        self._events = collections.deque()
+        self._events_signalled = False
+        self._event_fd, self._event_wfd = os.pipe()
+        _set_nonblocking(self._event_fd)
+        _set_nonblocking(self._event_wfd)
+        self._io_running = False
+
+    def start(self):
+        """
+        Start the node and its I/O thread
+        """
+        super(ThreadedZOCP, self).start()
+        self._io_running = True
+        self._thread = threading.Thread(target=self._io_loop, name="zocp-io")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop the I/O thread and the node
+        """
+        if self._thread is not None:
+            self.call_soon_threadsafe(self._stop_io)
+            self._thread.join()
+            self._thread = None
+        super(ThreadedZOCP, self).stop()
+        # unprocessed events hold bound methods of the node
+        self._events.clear()
+        os.close(self._event_fd)
+        os.close(self._event_wfd)
+
+    def fileno(self):
+        """
+        :return: a file descriptor which is readable when events are\
+                waiting for process_events
+        """
+        return self._event_fd
+
+    def process_events(self):
+        """
+        Call the on_* methods of the events received by the I/O thread,
+        from the calling thread
+
+        :return: the number of events handled
+        """
+        try:
+            while os.read(self._event_fd, 4096):
+                pass
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+        # reset after draining so a new event always leaves a byte
+        self._events_signalled = False
+        count = 0
+        while self._events:
+            callback, args = self._events.popleft()
+            callback(*args)
+            count += 1
+        return count
+
+    #########################################
+    # Methods queued to the I/O thread
+    #########################################
+    def emit_signal(self, emitter, value):
+        self._call_io(ZOCP.emit_signal, emitter, value)
+
+    def emit_signals(self, signals):
+        self._call_io(ZOCP.emit_signals, signals)
+
+    def set_capability(self, cap):
+        self._call_io(ZOCP.set_capability, cap)
+
+    def invalidate_capability(self):
+        self._call_io(ZOCP.invalidate_capability)
+
+    def set_node_location(self, location=[0,0,0]):
+        self._call_io(ZOCP.set_node_location, location)
+
+    def set_node_orientation(self, orientation=[0,0,0]):
+        self._call_io(ZOCP.set_node_orientation, orientation)
+
+    def set_node_scale(self, scale=[0,0,0]):
+        self._call_io(ZOCP.set_node_scale, scale)
+
+    def set_node_matrix(self, matrix=[[1,0,0,0],
+                                      [0,1,0,0],
+                                      [0,0,1,0],
+                                      [0,0,0,1]]):
+        self._call_io(ZOCP.set_node_matrix, matrix)
+
+    def set_object(self, name=None, type="Unknown", params=None):
+        self._call_io(ZOCP.set_object, name, type, params)
+
+    def register_params(self, params):
+        self._call_io(ZOCP.register_params, params)
+
+    def _begin_batch(self):
+        self._call_io(ZOCP._begin_batch)
+
+    def _end_batch(self):
+        self._call_io(ZOCP._end_batch)
+
+    def signal_subscribe(self, recv_peer, receiver, emit_peer, emitter):
+        self._call_io(ZOCP.signal_subscribe, recv_peer, receiver, emit_peer, emitter)
+
+    def signal_unsubscribe(self, recv_peer, receiver, emit_peer, emitter):
+        self._call_io(ZOCP.signal_unsubscribe, recv_peer, receiver, emit_peer, emitter)
+
+    def whisper(self, peer, msg_parts):
+        self._call_io(ZOCP.whisper, peer, msg_parts)
+
+    def shout(self, group, msg_parts):
+        self._call_io(ZOCP.shout, group, msg_parts)
+
+    def join(self, group):
+        self._call_io(ZOCP.join, group)
+
+    def leave(self, group):
+        self._call_io(ZOCP.leave, group)
+
+    def whispers(self, peer, format, *args):
+        self._call_io(ZOCP.whispers, peer, format, *args)
+
+    def shouts(self, group, format, *args):
+        self._call_io(ZOCP.shouts, group, format, *args)
+
+    def set_header(self, key, value):
+        self._call_io(ZOCP.set_header, key, value)
+
+    def set_verbose(self):
+        self._call_io(ZOCP.set_verbose)
+
+    def set_port(self, port_nbr):
+        self._call_io(ZOCP.set_port, port_nbr)
+
+    def set_interval(self, interval):
+        self._call_io(ZOCP.set_interval, interval)
+
+    def set_endpoint(self, format, *args):
+        self._call_io(ZOCP.set_endpoint, format, *args)
+
+    def peer_get(self, peer, keys, callback=None, timeout=None):
+        if callback is not None:
+            # deliver the callback to the application like events
+            callback = self._notify_callback(callback)
+        return self._request_io(ZOCP.peer_get, peer, keys, callback, timeout)
+
+    def peer_set(self, peer, data, callback=None, timeout=None):
+        if callback is not None:
+            callback = self._notify_callback(callback)
+        return self._request_io(ZOCP.peer_set, peer, data, callback, timeout)
+
+    def peer_call(self, peer, method, *args, **kwargs):
+        if kwargs.get('callback') is not None:
+            kwargs['callback'] = self._notify_callback(kwargs['callback'])
+        return self._request_io(ZOCP.peer_call, peer, method, *args, **kwargs)
+
+    #########################################
+    # Queries run on the I/O thread
+    #########################################
+    def peers(self):
+        return self._call_io_wait(ZOCP.peers)
+
+    def peers_by_group(self, group):
+        return self._call_io_wait(ZOCP.peers_by_group, group)
+
+    def endpoint(self):
+        return self._call_io_wait(ZOCP.endpoint)
+
+    def get_peer_name(self, peer):
+        return self._call_io_wait(ZOCP.get_peer_name, peer)
+
+    def peer_address(self, peer):
+        return self._call_io_wait(ZOCP.peer_address, peer)
+
+    def peer_header_value(self, peer, name):
+        return self._call_io_wait(ZOCP.peer_header_value, peer, name)
+
+    def peer_headers(self, peer):
+        return self._call_io_wait(ZOCP.peer_headers, peer)
+
+    def own_groups(self):
+        return self._call_io_wait(ZOCP.own_groups)
+
+    def peer_groups(self):
+        return self._call_io_wait(ZOCP.peer_groups)
+
+    #########################################
+    # Internal methods
+    #########################################
+    def _io_loop(self):
+        while self._io_running:
+            try:
+                self.run_once()
+            except Exception:
+                # a failing handler must not stop the node
+                logger.exception("ZOCP :%s: error in the I/O thread" %(self.name()))
+
+    def _stop_io(self):
+        self._io_running = False
+
+    def _in_io_thread(self):
+        return self._thread is None or threading.current_thread() is self._thread
+
+    def _call_io(self, method, *args):
+        """
+        Call a ZOCP method on the I/O thread
+        """
+        if self._in_io_thread():
+            method(self, *args)
+        else:
+            self.call_soon_threadsafe(method, self, *args)
+
+    def _call_io_wait(self, method, *args):
+        """
+        Call a ZOCP method on the I/O thread and wait for its result
+        """
+        if self._in_io_thread():
+            return method(self, *args)
+        future = concurrent.futures.Future()
+        def call():
+            try:
+                future.set_result(method(self, *args))
+            except Exception as e:
+                future.set_exception(e)
+        self.call_soon_threadsafe(call)
+        return future.result()
+
+    def _request_io(self, method, *args, **kwargs):
+        """
+        Send a request from the I/O thread
+
+        :return: a future resolved like the one of the request
+        """
+        if self._in_io_thread():
+            return method(self, *args, **kwargs)
+        future = concurrent.futures.Future()
+        def request():
+            try:
+                request_future = method(self, *args, **kwargs)
+            except Exception as e:
+                future.set_exception(e)
+                return
+            request_future.add_done_callback(lambda f: _chain_future(f, future))
+        self.call_soon_threadsafe(request)
+        return future
+
+    def _register_param(self, *args, **kwargs):
+        if self._in_io_thread():
+            ZOCP._register_param(self, *args, **kwargs)
+        else:
+            self.call_soon_threadsafe(lambda: ZOCP._register_param(self, *args, **kwargs))
+
+    def _on_modified(self, data, peer=None, name=None):
+        self._call_io(ZOCP._on_modified, data, peer, name)
+
+    def _schedule(self, timer):
+        if self._in_io_thread():
+            return ZOCP._schedule(self, timer)
+        self.call_soon_threadsafe(ZOCP._schedule, self, timer)
+        return timer
+
+    def _notify(self, callback, *args):
+        """
+        Queue an event for process_events
+        """
+        self._events.append((callback, args))
+        if not self._events_signalled:
+            self._events_signalled = True
+            try:
+                os.write(self._event_wfd, b'\0')
+            except OSError as e:
+                # a full pipe will wake the application anyway
+                if e.errno != errno.EAGAIN:
+                    raise
+
+    def _notify_callback(self, callback):
+        return lambda future: self._notify(callback, future)
+
+
+def _chain_future(source, target):
+    """
+    Copy the outcome of a done future to another future
+    """
+    if target.done():
+        return
+    if source.cancelled():
+        target.cancel()
+    elif source.exception() is not None:
+        target.set_exception(source.exception())
+    else:
+        target.set_result(source.result())
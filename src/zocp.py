@@ -16,13 +16,50 @@
 # License along with this library.
 
 from pyre import Pyre
+from pyre import zhelper
 import json
+import zlib
+import hashlib
+import os
+import struct
 import zmq
 import uuid
+import time
+import heapq
+import itertools
+import collections
+import concurrent.futures
+import threading
+import weakref
+import copy
 import logging
 
+try:
+    from collections.abc import Mapping, MutableMapping
+except ImportError:
+    from collections import Mapping, MutableMapping
+
+try:
+    from sys import intern
+except ImportError:
+    # a builtin on python 2
+    pass
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 logger = logging.getLogger(__name__)
 
+# timers and rate windows must not follow steps of the wall clock
+_clock = getattr(time, 'monotonic', time.time)
+
 def dict_get(d, keys):
     """
     returns a value from a nested dict
@@ -48,7 +85,7 @@ def dict_set(d, keys, value):
 
 def dict_get_keys(d, keylist=""):
     for k, v in d.items():
-        if isinstance(v, dict):
+        if isinstance(v, _mappings):
             # entering branch add seperator and enter
             keylist=keylist+".%s" %k
             keylist = dict_get_keys(v, keylist)
@@ -58,37 +95,513 @@ def dict_get_keys(d, keylist=""):
             #print(keylist)
     return keylist
 
+def values_equal(a, b):
+    """
+    compares two parameter values, numpy arrays are compared elementwise
+    """
+    if numpy is not None and (isinstance(a, numpy.ndarray) or
+                              isinstance(b, numpy.ndarray)):
+        return numpy.array_equal(a, b)
+    return a == b
+
+def _encode_default(obj):
+    """
+    converts values the codecs can't serialize, like parameters and
+    numpy arrays
+    """
+    if isinstance(obj, Parameter):
+        return obj.to_dict()
+    if hasattr(obj, 'tolist'):
+        return obj.tolist()
+    raise TypeError("%r is not serializable" %(obj,))
+
 # http://stackoverflow.com/questions/38987/how-can-i-merge-union-two-python-dictionaries-in-a-single-expression?rq=1
 def dict_merge(a, b, path=None):
     """
     merges b into a, overwites a with b if equal
     """
-    if not isinstance(a, dict):
+    if not isinstance(a, _mappings):
         return b
-    if path is None: path = []
-    for key in b.keys():
-        if key in a:
-            if isinstance(a[key], dict) and isinstance(b[key], dict):
-                dict_merge(a[key], b[key], path + [str(key)])
+    stack = [(a, b)]
+    while stack:
+        a_node, b_node = stack.pop()
+        for key, value in b_node.items():
+            current = a_node.get(key)
+            if isinstance(current, _mappings) and isinstance(value, _mappings):
+                stack.append((current, value))
             else:
-                a[key] = b[key]
-        else:
-            a[key] = b[key]
+                a_node[key] = value
     return a
 
+def dict_merge_diff(a, b):
+    """
+    merges b into a like dict_merge
+
+    :return: the merged dict and the items of b which changed a
+    """
+    if not isinstance(a, _mappings):
+        return b, b
+    diff = {}
+    nested = [] # (diff, key) of nested diffs, parents before children
+    stack = [(a, b, diff)]
+    while stack:
+        a_node, b_node, diff_node = stack.pop()
+        for key, value in b_node.items():
+            if key in a_node:
+                current = a_node[key]
+                if isinstance(current, _mappings) and isinstance(value, _mappings):
+                    child = diff_node[key] = {}
+                    nested.append((diff_node, key))
+                    stack.append((current, value, child))
+                    continue
+                if values_equal(current, value):
+                    continue
+            a_node[key] = value
+            diff_node[key] = value
+    # drop nested diffs without changes, children first
+    for diff_node, key in reversed(nested):
+        if not diff_node[key]:
+            del diff_node[key]
+    return a, diff
+
+class Parameter(MutableMapping):
+    """
+    A variable in a capability tree
+
+    Behaves like the dict it is sent as, but keeps the keys every
+    variable has in slots. The typeHint and access strings are interned
+    and other keys are kept in a dict.
+    """
+    __slots__ = ('value', 'typeHint', 'access', 'subscribers', 'min',
+                 'max', 'step', 'maxRate', 'deadband', '_extra')
+    # keys in the order they are sent
+    _keys = __slots__[:-1]
+
+    def __init__(self, data=None):
+        self._extra = None
+        if data is not None:
+            for key, value in data.items():
+                self[key] = value
+
+    def __getitem__(self, key):
+        try:
+            if key in _param_keys:
+                return getattr(self, key)
+            return self._extra[key]
+        except (AttributeError, TypeError):
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key in _param_keys:
+            if key in ('typeHint', 'access') and type(value) is str:
+                value = intern(value)
+            setattr(self, key, value)
+            return
+        if self._extra is None:
+            self._extra = {}
+        self._extra[key] = value
+
+    def __delitem__(self, key):
+        try:
+            if key in _param_keys:
+                delattr(self, key)
+            else:
+                del self._extra[key]
+        except (AttributeError, TypeError):
+            raise KeyError(key)
+
+    def __iter__(self):
+        for key in self._keys:
+            if hasattr(self, key):
+                yield key
+        if self._extra:
+            for key in self._extra:
+                yield key
+
+    def __len__(self):
+        return sum(1 for key in self)
+
+    def __repr__(self):
+        return "Parameter(%r)" %(self.to_dict(),)
+
+    def to_dict(self):
+        """
+        :return: the parameter as a dict, as it is sent to peers
+        """
+        return dict((key, self[key]) for key in self)
+
+_param_keys = frozenset(Parameter._keys)
+# types the capability tree is built of
+_mappings = (dict, Parameter)
+
+def param_index(tree, index=None, delta=None):
+    """
+    Index the variables of a capability tree by their dotted path,
+    e.g. 'objects.Cube.location' for nested objects
+
+    Variables still stored as a dict are replaced by a Parameter.
+
+    :param dict index: the index to update, a new one is created if None
+    :param dict delta: only index the parts of the tree this modification\
+                changed, it must already be merged into the tree
+    :return: the index
+    """
+    if index is None:
+        index = {}
+    if delta is None:
+        delta = tree
+    stack = [("", tree, delta)]
+    while stack:
+        prefix, node, delta_node = stack.pop()
+        for key, value in delta_node.items():
+            child = node.get(key)
+            if not (isinstance(child, _mappings) and isinstance(value, _mappings)):
+                continue
+            path = prefix + key
+            if isinstance(child, Parameter):
+                index[path] = child
+            elif 'typeHint' in child:
+                index[path] = node[key] = Parameter(child)
+            else:
+                stack.append((path + ".", child, value))
+    return index
+
+class JSONCodec(object):
+    """
+    Encodes ZOCP messages as UTF-8 JSON
+
+    Every ZOCP node understands JSON so this codec is always used when
+    a peer does not advertise any codec we speak.
+    """
+    name = "json"
+    # a JSON encoded message always starts with the opening brace
+    marker = b'{'
+    available = True
+
+    def encode(self, data):
+        return json.dumps(data, default=_encode_default).encode('utf-8')
+
+    def decode(self, payload):
+        return json.loads(payload.decode('utf-8'))
+
+    def encode_value(self, value):
+        """
+        Encode a value to be spliced into messages by encode_raw
+        """
+        return json.dumps(value, default=_encode_default).encode('utf-8')
+
+    def encode_raw(self, method, raw, args=None, extra=None):
+        """
+        Encode {method: value}, or {method: args + [value]} if args is
+        given, where the value is already encoded by encode_value
+
+        :param dict extra: other items of the message
+        """
+        msg = [b'{']
+        if extra:
+            # strip the braces to prepend the items
+            msg.append(self.encode_value(extra)[1:-1] + b', ')
+        msg.append(json.dumps(method).encode('utf-8') + b': ')
+        if args is None:
+            msg.append(raw)
+        elif not args:
+            msg.append(b'[' + raw + b']')
+        else:
+            # strip the closing bracket to append the encoded value
+            msg.append(self.encode_value(list(args))[:-1] + b', ' + raw + b']')
+        msg.append(b'}')
+        return b''.join(msg)
+
+class MsgPackCodec(object):
+    """
+    Encodes ZOCP messages as MessagePack, prefixed with a marker byte
+
+    Only available if the msgpack module is installed
+    """
+    name = "msgpack"
+    marker = b'\x01'
+    available = msgpack is not None
+
+    def encode(self, data):
+        return self.marker + msgpack.packb(data, use_bin_type=True,
+                                           default=_encode_default)
+
+    def decode(self, payload):
+        return msgpack.unpackb(memoryview(payload)[1:], raw=False,
+                               strict_map_key=False)
+
+    def encode_value(self, value):
+        """
+        Encode a value to be spliced into messages by encode_raw
+        """
+        return msgpack.packb(value, use_bin_type=True, default=_encode_default)
+
+    def encode_raw(self, method, raw, args=None, extra=None):
+        """
+        Encode {method: value}, or {method: args + [value]} if args is
+        given, where the value is already encoded by encode_value
+
+        :param dict extra: other items of the message
+        """
+        # fixmaps and fixarrays hold up to 15 items
+        extra = extra or {}
+        msg = [self.marker, struct.pack('B', 0x80 | (len(extra) + 1))]
+        for key, value in extra.items():
+            msg.append(self.encode_value(key))
+            msg.append(self.encode_value(value))
+        msg.append(self.encode_value(method))
+        if args is not None:
+            msg.append(struct.pack('B', 0x90 | (len(args) + 1)))
+            msg.extend(self.encode_value(arg) for arg in args)
+        msg.append(raw)
+        return b''.join(msg)
+
+json_codec = JSONCodec()
+# codecs in order of preference, JSON comes last as the fallback
+default_codecs = [c for c in (MsgPackCodec(), json_codec) if c.available]
+
+# Typed signal frames carry a single SIG as a fixed layout struct:
+# marker, type code and emitter index followed by the packed value.
+# The emitter index is announced to the receiver once using SIGID.
+SIG_FRAME = "struct"
+SIG_FRAME_MARKER = b'\x02'
+_sig_frame_header = struct.Struct('<cBH')
+_sig_frame_formats = (
+    # code, typeHint, value format, is vector
+    (1, 'int',     'q',  False),
+    (2, 'flt',     'd',  False),
+    (3, 'percent', 'd',  False),
+    (4, 'bool',    '?',  False),
+    (5, 'vec2f',   '2d', True),
+    (6, 'vec3f',   '3d', True),
+    (7, 'vec4f',   '4d', True),
+)
+# typeHint : (code, frame struct, is vector)
+_sig_frame_encoders = dict((hint, (code, struct.Struct('<cBH' + fmt), vec))
+                           for code, hint, fmt, vec in _sig_frame_formats)
+# code : (value struct, is vector)
+_sig_frame_decoders = dict((code, (struct.Struct('<' + fmt), vec))
+                           for code, hint, fmt, vec in _sig_frame_formats)
+
+# Array signals are sent as two frames: the marker followed by a JSON
+# header [emitter, dtype, shape] and the raw buffer of the array.
+ARRAY_FRAME = "array"
+ARRAY_FRAME_MARKER = b'\x03'
+
+# Large messages to peers accepting it are compressed with zlib using a
+# preset dictionary of the keys and values every capability repeats, as
+# JSON and as MessagePack. Changing the dictionary breaks compatibility.
+ZLIB_FRAME = "zlib"
+ZLIB_FRAME_MARKER = b'\x04'
+_zlib_words = [b'value', b'typeHint', b'access', b'subscribers', b'min',
+               b'max', b'step', b'maxRate', b'deadband', b'objects', b'type',
+               b'int', b'flt', b'percent', b'bool', b'string', b'vec2f',
+               b'vec3f', b'vec4f', b'array', b'method', b'MOD', b'VER',
+               b'REP', b'rw', b'rwe', b'rws', b'true', b'false', b'null']
+_zlib_dict = b''.join([struct.pack('B', 0xa0 | len(word)) + word for word in _zlib_words] +
+                      [b'"' + word + b'": ' for word in _zlib_words] +
+                      [b'{"value": ', b', "typeHint": "flt", "access": "rw", "subscribers": []}, '])
+# never inflate a message beyond this size
+ZLIB_MAX_SIZE = 64 * 1024 * 1024
+
+# protocol extensions this implementation supports, advertised in the
+# X-ZOCP-EXT header. Extensions are only used with peers listing them.
+SIGB_EXT = "sigb"   # batches of signals in a single SIGB message
+REQ_EXT = "req"     # GET, SET and CALL carry an ID answered by a REP
+VER_EXT = "ver"     # MODs carry the capability version, gaps are fetched by SINCE
+extensions = [SIGB_EXT, REQ_EXT, VER_EXT]
+
+def canonical_capability(cap):
+    """
+    Encode a capability as JSON with sorted keys, equal capabilities
+    always give the same bytes
+
+    :return: the encoded capability and its hash
+    """
+    text = json.dumps(cap, sort_keys=True, default=_encode_default).encode('utf-8')
+    return text, hashlib.sha1(text).hexdigest()
+
+def _update_capability_hash(node_ref):
+    node = node_ref()
+    if node is not None:
+        node._update_capability_hash()
+
+def _log_call_failure(future, node_name, name):
+    """
+    Log the failure of a CALL without request id which ran on an executor
+    """
+    if future.cancelled():
+        return
+    e = future.exception()
+    if e is not None:
+        logger.error("ZOCP :%s: CALL from %s failed: %s" %(node_name, name, e))
+
+class ZOCPRequestError(Exception):
+    """
+    Raised by the future of a request the peer failed to handle
+    """
+    pass
+
+class ZOCPTimer(object):
+    """
+    A callback scheduled on a ZOCP node by call_later or call_every
+    """
+    def __init__(self, deadline, interval, callback, args):
+        self.deadline = deadline
+        self.interval = interval
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        """
+        Prevent the callback from being called (again)
+        """
+        self.cancelled = True
+
+class Peer(object):
+    """
+    The state a ZOCP node keeps of a peer
+    """
+    __slots__ = ('id', 'uuid', 'name', 'address', 'capability', 'params',
+                 'subscriptions', 'subscribers', 'messages', 'signals',
+                 'codec', 'exts', 'sig_frames', 'array_frames', 'zlib',
+                 'sig_names', 'sig_announced', 'mod_version', 'version',
+                 'legacy_gets')
+
+    def __init__(self, peer):
+        self.id = peer.bytes
+        self.uuid = peer
+        self.name = None
+        self.address = None
+        self.capability = None # the peer's capability, once known
+        self.params = {} # dotted path : variable of the capability
+        self.subscriptions = {} # emitter of the peer : our receivers
+        self.subscribers = {} # our emitter : receivers of the peer
+        self.messages = 0 # messages received
+        self.signals = 0 # signals received
+        self.codec = json_codec # codec used to send to the peer
+        self.exts = frozenset() # supported extensions
+        self.sig_frames = False # accepts typed signal frames
+        self.array_frames = False # accepts array frames
+        self.zlib = False # accepts compressed messages
+        self.sig_names = {} # emitter index : emitter of its signal frames
+        self.sig_announced = set() # our emitter indices announced to it
+        self.mod_version = None # version of the last MOD sent to it
+        self.version = None # version of its capability we have
+        self.legacy_gets = collections.deque() # (keys, future) of GETs without a request id
+
+class _PeerView(Mapping):
+    """
+    A read-only view on an item of the peer records by peer id
+    """
+    __slots__ = ('_peers', '_attr', '_empty')
+
+    def __init__(self, peers, attr, empty=False):
+        self._peers = peers
+        self._attr = attr
+        # whether peers with an empty item are in the view
+        self._empty = empty
+
+    def __getitem__(self, peer):
+        try:
+            value = getattr(self._peers[peer.bytes], self._attr)
+        except (KeyError, AttributeError):
+            raise KeyError(peer)
+        if value is None or not (value or self._empty):
+            raise KeyError(peer)
+        return value
+
+    def __iter__(self):
+        for record in list(self._peers.values()):
+            value = getattr(record, self._attr)
+            if value is not None and (value or self._empty):
+                yield record.uuid
+
+    def __len__(self):
+        return sum(1 for peer in self)
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
 class ZOCP(Pyre):
     """
     The ZOCP class provides all methods for ZOCP nodes
     
     :param str name: Name of the node, if not given a random name will be created
+    :param list codecs: codecs this node speaks in order of preference,\
+                defaults to all available codecs
+    :param executor: a concurrent.futures executor running registered\
+                methods called by peers, by default they run in the\
+                run loop
+    :param str capability_cache: directory to store the capabilities of\
+                peers in, by their hash. Capabilities are always cached\
+                in memory
+    :param int compress_threshold: messages of at least this many bytes are\
+                compressed for peers supporting it, None disables compression
     """
+    # seconds between updates of the capability hash header
+    capability_hash_interval = 1.0
+    # number of peer capabilities cached in memory
+    capability_cache_size = 256
+    # number of modifications kept to answer SINCE requests
+    delta_log_size = 256
+    # bytes of encoded modifications kept to answer SINCE requests
+    delta_log_bytes = 1024 * 1024
+
     def __init__(self, *args, **kwargs):
+        # Pyre passes unknown keyword arguments on to object
+        capability = kwargs.pop('capability', {})
+        codecs = kwargs.pop('codecs', default_codecs)
+        executor = kwargs.pop('executor', None)
+        capability_cache = kwargs.pop('capability_cache', None)
+        compress_threshold = kwargs.pop('compress_threshold', 4096)
         super(ZOCP, self).__init__(*args, **kwargs)
-        self.subscriptions = {}
-        self.subscribers = {}
+        self._peers = {} # peer id bytes : Peer
+        self._last_peer = None # record of the last peer looked up
+        # read-only views by peer id on the peer records
+        self.subscriptions = _PeerView(self._peers, 'subscriptions')
+        self.subscribers = _PeerView(self._peers, 'subscribers')
+        self.peers_capabilities = _PeerView(self._peers, 'capability', empty=True)
+        self._emitter_subscribers = {} # emitter : set of subscribed peer records
+        self._wildcard_subscribers = set() # records of peers subscribed to all emitters
+        self._throttled = {} # emitter : [end of rate window, value pending]
+        self._timers = [] # heap of (deadline, sequence, timer)
+        self._timer_seq = itertools.count()
+        self._last_signal = {} # emitter : last sent value for deadbands
         self.set_header("X-ZOCP", "1")
-        self.peers_capabilities = {} # peer id : capability data
-        self.capability = kwargs.get('capability', {})
+        self.codecs = codecs
+        self._codecs_by_marker = dict((c.marker, c) for c in self.codecs)
+        # we can always decode JSON, even if we prefer not to send it
+        self._codecs_by_marker[json_codec.marker] = json_codec
+        self._sig_index = {} # emitter : emitter index in typed signal frames
+        self.compress_threshold = compress_threshold
+        frames = [SIG_FRAME, ZLIB_FRAME]
+        if numpy is not None:
+            frames.append(ARRAY_FRAME)
+        self.set_header("X-ZOCP-CODEC", ",".join(
+            [c.name for c in self.codecs] + frames))
+        self.set_header("X-ZOCP-EXT", ",".join(extensions))
+        self._requests = {} # request id : [peer, method, future, timer, data]
+        self._request_ids = itertools.count(1)
+        self.executor = executor
+        self._methods = {} # method name : (callable, executor)
+        self._capability_cache = {} # codec name : encoded capability
+        self._capability_hash_dirty = True
+        self._peer_cap_store = collections.OrderedDict() # hash : encoded capability
+        self._peer_cap_dir = capability_cache
+        self._version = 0 # bumped on every modification of the capability
+        self._delta_log = collections.deque() # (version, JSON encoded data)
+        self._delta_log_used = 0 # bytes in the delta log
+        self._mod_version = None # VER of the message being handled
+        self._batch_depth = 0
+        self._batch_modified = collections.OrderedDict() # (peer, name) : merged data
+        self._batch_signals = collections.OrderedDict() # emitter : value
+        self._calls = collections.deque() # (callback, args) from other threads
+        self._calls_lock = threading.Lock()
+        self._build_handlers()
+        self.capability = capability
+        self._params = param_index(capability) # dotted path : variable
         self._cur_obj = self.capability
         self._cur_obj_keys = ()
         self._running = False
@@ -96,10 +609,30 @@ class ZOCP(Pyre):
         self.join("ZOCP")
         self.poller = zmq.Poller()
         self.poller.register(self.inbox, zmq.POLLIN)
+        # other threads wake the run loop through this pipe
+        self._wakeup, self._wakeup_pipe = zhelper.zcreate_pipe(self._ctx)
+        self.poller.register(self._wakeup, zmq.POLLIN)
 
     #########################################
     # Node methods. 
     #########################################
+    def start(self):
+        """
+        Start the node, advertising the hash of its capability
+        """
+        self._update_capability_hash()
+        super(ZOCP, self).start()
+
+    def stop(self):
+        """
+        Stop the node, dropping its pending timers and calls
+        """
+        super(ZOCP, self).stop()
+        # cancelled timers stay queued until their deadline and hold
+        # bound methods, keeping the node alive in a reference cycle
+        self._timers = []
+        self._calls.clear()
+
     def set_capability(self, cap):
         """
         Set node's capability, overwites previous
@@ -115,6 +648,25 @@ class ZOCP(Pyre):
         """
         return self.capability
 
+    def invalidate_capability(self):
+        """
+        Drop the cached encoded capability sent in GET replies and
+        update the capability hash, needed after changing the capability
+        dictionary without node methods
+        """
+        self._params = param_index(self.capability)
+        self._drop_capability_cache()
+
+    def _drop_capability_cache(self):
+        self._capability_cache.clear()
+        if not self._capability_hash_dirty:
+            self._capability_hash_dirty = True
+            # peers entering before the new hash is advertised must
+            # not trust the old one
+            self.set_header("X-ZOCP-CAPHASH", "")
+            # a bound method in the timer would keep the node alive
+            self.call_later(self.capability_hash_interval, _update_capability_hash, weakref.ref(self))
+
     def set_node_location(self, location=[0,0,0]):
         """
         Set node's location, overwites previous
@@ -146,33 +698,101 @@ class ZOCP(Pyre):
         self.capability['_matrix'] = matrix
         self._on_modified(data={'_matrix':matrix})
 
-    def set_object(self, name=None, type="Unknown"):
+    def set_object(self, name=None, type="Unknown", params=None):
         """
         Create a new object on this nodes capability
+
+        Variables registered next are added to the object, if name is
+        None they are added to the capability itself.
+
+        :param list params: variables to register on the object, see\
+                    register_params. The object and its variables are\
+                    published as a single modification
         """
         if name == None:
             self._cur_obj = self.capability
             self._cur_obj_keys = ()
+            if params is not None:
+                self.register_params(params)
+            return
         if not self.capability.get('objects'):
             self.capability['objects'] = {name: {'type': type}}
         elif not self.capability['objects'].get(name):
             self.capability['objects'][name] = {'type': type}
         else:
             self.capability['objects'][name]['type'] = type
+        self._drop_capability_cache()
         self._cur_obj = self.capability['objects'][name]
         self._cur_obj_keys = ('objects', name)
+        if params is not None:
+            with self.batch():
+                self._on_modified(data={'type': type})
+                self.register_params(params)
+
+    def register_params(self, params):
+        """
+        Register multiple variables, publishing a single modification
+
+        :param list params: a dict per variable holding its name, value and\
+                    typeHint and optionally its access, min, max, step,\
+                    maxRate and deadband, as in the capability tree. A dict\
+                    of these dicts by variable name is also accepted
+        """
+        if isinstance(params, dict):
+            params = [dict(spec, name=name) for name, spec in params.items()]
+        with self.batch():
+            for spec in params:
+                self._register_param(spec['name'], spec.get('value'), spec['typeHint'],
+                                     spec.get('access', 'r'), spec.get('min'),
+                                     spec.get('max'), spec.get('step'),
+                                     spec.get('maxRate'), spec.get('deadband'))
+
+    def batch(self):
+        """
+        Return a context manager combining the modifications and signals
+        of its block
+
+        On leaving the outermost block on_modified is called once and
+        the combined modification is published as one MOD, or as one
+        SIGB if only values changed. Emitted signals are sent as if by
+        a single call to emit_signals::
 
-    def _register_param(self, name, value, type_hint, access='r', min=None, max=None, step=None):
-        self._cur_obj[name] = {'value': value, 'typeHint': type_hint, 'access':access, 'subscribers': [] }
+            with node.batch():
+                node.set_node_location([1, 0, 0])
+                node.set_node_orientation([0, 90, 0])
+        """
+        return _Batch(self)
+
+    def _begin_batch(self):
+        self._batch_depth += 1
+
+    def _end_batch(self):
+        self._batch_depth -= 1
+        if self._batch_depth:
+            return
+        modified, self._batch_modified = self._batch_modified, collections.OrderedDict()
+        signals, self._batch_signals = self._batch_signals, collections.OrderedDict()
+        for (peer, name), data in modified.items():
+            self._publish_modified(data, peer, name)
+        if signals:
+            self.emit_signals(signals)
+
+    def _register_param(self, name, value, type_hint, access='r', min=None, max=None, step=None, max_rate=None, deadband=None):
+        param = Parameter({'value': value, 'typeHint': type_hint, 'access':access, 'subscribers': [] })
         if min:
-            self._cur_obj[name]['min'] = min
+            param.min = min
         if max:
-            self._cur_obj[name]['max'] = max
+            param.max = max
         if step:
-            self._cur_obj[name]['step'] = step
-        self._on_modified(data={name: self._cur_obj[name]})
+            param.step = step
+        if max_rate:
+            param.maxRate = max_rate
+        if deadband:
+            param.deadband = deadband
+        self._cur_obj[name] = param
+        self._on_modified(data={name: param})
 
-    def register_int(self, name, value, access='r', min=None, max=None, step=None):
+    def register_int(self, name, value, access='r', min=None, max=None, step=None, max_rate=None, deadband=None):
         """
         Register an integer variable
 
@@ -182,11 +802,15 @@ class ZOCP(Pyre):
         :param int min: minimal value
         :param int max: maximal value
         :param int step: step value for increments and decrements
-        
+        :param float max_rate: maximum number of signals per second, only the\
+                    newest value is sent when signals arrive faster
+        :param deadband: signals within this absolute difference of the last\
+                    sent value are not sent, a string like '5%' sets a\
+                    relative difference. Applied per component for vectors
         """
-        self._register_param(name, value, 'int', access, min, max, step)
+        self._register_param(name, value, 'int', access, min, max, step, max_rate=max_rate, deadband=deadband)
 
-    def register_float(self, name, value, access='r', min=None, max=None, step=None):
+    def register_float(self, name, value, access='r', min=None, max=None, step=None, max_rate=None, deadband=None):
         """
         Register a float variable
 
@@ -196,10 +820,15 @@ class ZOCP(Pyre):
         :param float min: minimal value
         :param float max: maximal value
         :param float step: step value for increments and decrements
+        :param float max_rate: maximum number of signals per second, only the\
+                    newest value is sent when signals arrive faster
+        :param deadband: signals within this absolute difference of the last\
+                    sent value are not sent, a string like '5%' sets a\
+                    relative difference. Applied per component for vectors
         """
-        self._register_param(name, value, 'flt', access, min, max, step)
+        self._register_param(name, value, 'flt', access, min, max, step, max_rate=max_rate, deadband=deadband)
 
-    def register_percent(self, name, value, access='r', min=None, max=None, step=None):
+    def register_percent(self, name, value, access='r', min=None, max=None, step=None, max_rate=None, deadband=None):
         """
         Register a percentage variable
 
@@ -209,30 +838,39 @@ class ZOCP(Pyre):
         :param float min: minimal value
         :param float max: maximal value
         :param float step: step value for increments and decrements
+        :param float max_rate: maximum number of signals per second, only the\
+                    newest value is sent when signals arrive faster
+        :param deadband: signals within this absolute difference of the last\
+                    sent value are not sent, a string like '5%' sets a\
+                    relative difference. Applied per component for vectors
         """
-        self._register_param(name, value, 'percent', access, min, max, step)
+        self._register_param(name, value, 'percent', access, min, max, step, max_rate=max_rate, deadband=deadband)
 
-    def register_bool(self, name, value, access='r'):
+    def register_bool(self, name, value, access='r', max_rate=None):
         """
         Register an integer variable
 
         :param str name: the name of the variable as how nodes can refer to it
         :param bool value: the variable value
         :param str access: the access state of the variable. 'r'=readable, 'w'=writeable, 'e'=signal emitter, 's'=signal sensor
+        :param float max_rate: maximum number of signals per second, only the\
+                    newest value is sent when signals arrive faster
         """
-        self._register_param(name, value, 'bool', access)
+        self._register_param(name, value, 'bool', access, max_rate=max_rate)
 
-    def register_string(self, name, value, access='r'):
+    def register_string(self, name, value, access='r', max_rate=None):
         """
         Register a string variable
 
         :param str name: the name of the variable as how nodes can refer to it
         :param str value: the variable value
         :param str access: set the access state of the variable. 'r'=readable, 'w'=writeable, 'e'=signal emitter, 's'=signal sensor
+        :param float max_rate: maximum number of signals per second, only the\
+                    newest value is sent when signals arrive faster
         """
-        self._register_param(name, value, 'string', access)
+        self._register_param(name, value, 'string', access, max_rate=max_rate)
 
-    def register_vec2f(self, name, value, access='r', min=None, max=None, step=None):
+    def register_vec2f(self, name, value, access='r', min=None, max=None, step=None, max_rate=None, deadband=None):
         """
         Register a 2 dimensional vector variable
 
@@ -242,10 +880,15 @@ class ZOCP(Pyre):
         :param tuple min: minimal value
         :param tuple max: maximal value
         :param tuple step: step value for increments and decrements
+        :param float max_rate: maximum number of signals per second, only the\
+                    newest value is sent when signals arrive faster
+        :param deadband: signals within this absolute difference of the last\
+                    sent value are not sent, a string like '5%' sets a\
+                    relative difference. Applied per component for vectors
         """
-        self._register_param(name, value, 'vec2f', access, min, max, step)
+        self._register_param(name, value, 'vec2f', access, min, max, step, max_rate=max_rate, deadband=deadband)
 
-    def register_vec3f(self, name, value, access='r', min=None, max=None, step=None):
+    def register_vec3f(self, name, value, access='r', min=None, max=None, step=None, max_rate=None, deadband=None):
         """
         Register a three dimensional vector variable
 
@@ -255,10 +898,15 @@ class ZOCP(Pyre):
         :param tuple min: minimal value
         :param tuple max: maximal value
         :param tuple step: step value for increments and decrements
+        :param float max_rate: maximum number of signals per second, only the\
+                    newest value is sent when signals arrive faster
+        :param deadband: signals within this absolute difference of the last\
+                    sent value are not sent, a string like '5%' sets a\
+                    relative difference. Applied per component for vectors
         """
-        self._register_param(name, value, 'vec3f', access, min, max, step)
+        self._register_param(name, value, 'vec3f', access, min, max, step, max_rate=max_rate, deadband=deadband)
 
-    def register_vec4f(self, name, value, access='r', min=None, max=None, step=None):
+    def register_vec4f(self, name, value, access='r', min=None, max=None, step=None, max_rate=None, deadband=None):
         """
         Register a four dimensional vector variable
 
@@ -268,55 +916,110 @@ class ZOCP(Pyre):
         :param tuple min: minimal value
         :param tuple max: maximal value
         :param tuple step: step value for increments and decrements
+        :param float max_rate: maximum number of signals per second, only the\
+                    newest value is sent when signals arrive faster
+        :param deadband: signals within this absolute difference of the last\
+                    sent value are not sent, a string like '5%' sets a\
+                    relative difference. Applied per component for vectors
+        """
+        self._register_param(name, value, 'vec4f', access, min, max, step, max_rate=max_rate, deadband=deadband)
+
+    def register_array(self, name, value, access='r', max_rate=None):
+        """
+        Register a numpy array variable
+
+        Signals of arrays are sent as raw buffers to peers supporting it.
+        Received arrays are read-only views on the received data.
+
+        :param str name: the name of the variable as how nodes can refer to it
+        :param numpy.ndarray value: the variable value
+        :param str access: the access state of the variable. 'r'=readable, 'w'=writeable, 'e'=signal emitter, 's'=signal sensor
+        :param float max_rate: maximum number of signals per second, only the\
+                    newest value is sent when signals arrive faster
+        """
+        if numpy is None:
+            raise ImportError("numpy is required for array parameters")
+        self._register_param(name, value, 'array', access, max_rate=max_rate)
+
+    def register_method(self, name, method, executor=None):
         """
-        self._register_param(name, value, 'vec4f', access, min, max, step)
+        Register a method peers can call with peer_call
+
+        :param str name: the name of the method as how nodes can refer to it
+        :param callable method: called with the arguments of the call, its\
+                    return value is sent back to the caller
+        :param executor: a concurrent.futures executor to run the method on,\
+                    defaults to the executor of the node, False runs it in\
+                    the run loop. Methods run on a ProcessPoolExecutor must\
+                    be picklable
+        """
+        if executor is None:
+            executor = self.executor
+        self._methods[name] = (method, executor or None)
+        self._register_param(name, None, 'method', 'x')
 
     def get_value(self, name):
         """
         Retrieve the current value of a named parameter in the capability tree
 
-        :param str name: the name of the variable as how nodes refer to it
+        :param str name: the name of the variable as how nodes refer to it,\
+                variables of objects are named by their path like\
+                'objects.Cube.location'
         :return: the value of the named variable
 
         .. note:
             This is a temporary convenience method
         """
-        # TODO: could use dict_get(self.capability, keys)
-        # for nested values
-        return self.capability[name]['value']
+        return self._params[name].value
 
     #########################################
     # Node methods to peers
     #########################################
-    def peer_get_capability(self, peer):
+    def peer_get_capability(self, peer, callback=None, timeout=None):
         """
         Get the capabilities of peer
 
         Convenience method since it's the same a calling GET on a peer with no 
         data
         """
-        self.peer_get(peer, None)
+        return self.peer_get(peer, None, callback, timeout)
 
-    def peer_get(self, peer, keys):
+    def peer_get(self, peer, keys, callback=None, timeout=None):
         """
         Get items from peer
+
+        The reply also updates peers_capabilities and fires
+        on_peer_modified as before.
+
+        :param uuid peer: the id of the peer
+        :param list keys: names of the items to get, or None to get\
+                    the complete capability
+        :param callable callback: called with the future when it is done
+        :param float timeout: seconds after which the future fails with\
+                    concurrent.futures.TimeoutError
+        :return: a concurrent.futures.Future resolving to the items
         """
-        msg = json.dumps({'GET': keys})
-        self.whisper(peer, msg.encode('utf-8'))
+        return self._request(peer, 'GET', keys, callback, timeout)
 
-    def peer_set(self, peer, data):
+    def peer_set(self, peer, data, callback=None, timeout=None):
         """
         Set items on peer
+
+        :return: a concurrent.futures.Future resolving when the peer\
+                handled the SET
         """
-        msg = json.dumps({'SET': data})
-        self.whisper(peer, msg.encode('utf-8'))
+        return self._request(peer, 'SET', data, callback, timeout)
 
-    def peer_call(self, peer, method, *args):
+    def peer_call(self, peer, method, *args, **kwargs):
         """
         Call method on peer
+
+        Accepts the callback and timeout keyword arguments of peer_get.
+
+        :return: a concurrent.futures.Future resolving to the result
         """
-        msg = json.dumps({'CALL': [method, args]})
-        self.whisper(peer, msg.encode('utf-8'))
+        return self._request(peer, 'CALL', [method, args],
+                             kwargs.get('callback'), kwargs.get('timeout'))
 
     def signal_subscribe(self, recv_peer, receiver, emit_peer, emitter):
         """
@@ -338,47 +1041,28 @@ class ZOCP(Pyre):
         """
         if recv_peer == self.uuid():
             # we are the receiver so register the emitter
-            peer_subscriptions = {}
-            if emit_peer in self.subscriptions:
-                peer_subscriptions = self.subscriptions[emit_peer]
-            if not emitter in peer_subscriptions:
-                peer_subscriptions[emitter] = [receiver]
-            elif not receiver in peer_subscriptions[emitter]:
-                peer_subscriptions[emitter].append(receiver)
-            self.subscriptions[emit_peer] = peer_subscriptions
-
-            # check if the peer capability is known
-            if receiver is not None:
-                if receiver not in self.peers_capabilities:
-                    self.peer_get(recv_peer, {receiver: {}})
+            receivers = self._add_peer(emit_peer).subscriptions.setdefault(emitter, [])
+            if not receiver in receivers:
+                receivers.append(receiver)
 
         if emit_peer == self.uuid():
             # we are the emitter so register the receiver
             # update subscribers in capability tree
             subscriber = (recv_peer.hex, receiver)
-            subscribers = self.capability[emitter]["subscribers"]
+            subscribers = self._params[emitter].subscribers
             if subscriber not in subscribers:
                 subscribers.append(subscriber)
-                self._on_modified(data={emitter: {"subscribers": subscribers}})
-
-            peer_subscribers = {}
-            if recv_peer in self.subscribers:
-                peer_subscribers = self.subscribers[recv_peer]
-            if not emitter in peer_subscribers:
-                peer_subscribers[emitter] = [receiver]
-            elif not receiver in peer_subscribers[emitter]:
-                peer_subscribers[emitter].append(receiver)
-            self.subscribers[recv_peer] = peer_subscribers
+                self._on_param_modified(emitter, {"subscribers": subscribers})
+
+            self._add_subscriber(recv_peer, emitter, receiver)
             # we don't need to call the peer subscribed event as we initiated it
             # and we don't know the name
             #self.on_peer_subscribed(recv_peer, name, data)
 
-            msg = json.dumps({'SUB': [emit_peer.hex, emitter, recv_peer.hex, receiver]})
-            self.whisper(recv_peer, msg.encode('utf-8'))
+            self._whisper_data(recv_peer, {'SUB': [emit_peer.hex, emitter, recv_peer.hex, receiver]})
             return
 
-        msg = json.dumps({'SUB': [emit_peer.hex, emitter, recv_peer.hex, receiver]})
-        self.whisper(emit_peer, msg.encode('utf-8'))
+        self._whisper_data(emit_peer, {'SUB': [emit_peer.hex, emitter, recv_peer.hex, receiver]})
 
     def signal_unsubscribe(self, recv_peer, receiver, emit_peer, emitter):
         """
@@ -399,57 +1083,139 @@ class ZOCP(Pyre):
         """
         if recv_peer == self.uuid():
             # we are the receiver so unregister the emitter
-            if (emit_peer in self.subscriptions and
-                    emitter in self.subscriptions[emit_peer] and
-                    receiver in self.subscriptions[emit_peer][emitter]):
-                self.subscriptions[emit_peer][emitter].remove(receiver)
-                if not any(self.subscriptions[emit_peer][emitter]):
-                    self.subscriptions[emit_peer].pop(emitter)
-                if not any(self.subscriptions[emit_peer]):
-                    self.subscriptions.pop(emit_peer)
+            record = self._peers.get(emit_peer.bytes)
+            receivers = record.subscriptions.get(emitter) if record is not None else None
+            if receivers is not None and receiver in receivers:
+                receivers.remove(receiver)
+                if not any(receivers):
+                    record.subscriptions.pop(emitter)
 
         if emit_peer == self.uuid():
             # we are the emitter so unregister the receiver
             # update subscribers in capability tree
             subscriber = (recv_peer.hex, receiver)
-            subscribers = self.capability[emitter]["subscribers"]
+            subscribers = self._params[emitter].subscribers
             if subscriber in subscribers:
                 subscribers.remove(subscriber)
-                self._on_modified(data={emitter: {"subscribers": subscribers}})
+                self._on_param_modified(emitter, {"subscribers": subscribers})
 
-            if (recv_peer in self.subscribers and
-                emitter in self.subscribers[recv_peer] and
-                receiver in self.subscribers[recv_peer][emitter]):
-                self.subscribers[recv_peer][emitter].remove(receiver)
-                if not any(self.subscribers[recv_peer]):
-                    self.subscribers.pop(recv_peer)
-                elif not any(self.subscribers[recv_peer][emitter]):
-                    self.subscribers[recv_peer].pop(emitter)
+            self._remove_subscriber(recv_peer, emitter, receiver)
 
             #self.on_peer_unsubscribed(peer, name, data)
 
-            msg = json.dumps({'UNSUB': [emit_peer.hex, emitter, recv_peer.hex, receiver]})
-            self.whisper(recv_peer, msg.encode('utf-8'))
+            self._whisper_data(recv_peer, {'UNSUB': [emit_peer.hex, emitter, recv_peer.hex, receiver]})
             return
 
-        msg = json.dumps({'UNSUB': [emit_peer.hex, emitter, recv_peer.hex, receiver]})
-        self.whisper(emit_peer, msg.encode('utf-8'))
+        self._whisper_data(emit_peer, {'UNSUB': [emit_peer.hex, emitter, recv_peer.hex, receiver]})
 
     def emit_signal(self, emitter, value):
         """
         Update the value of the emitter and signal all subscribed receivers
 
-        :param str emitter: name of the emitting variable
+        :param str emitter: name of the emitting variable, variables of\
+                    objects are named by their path like 'objects.Cube.location'
         :param value: the new value
         """
-        self.capability[emitter]['value'] = value
-        msg = json.dumps({'SIG': [emitter, value]}).encode('utf-8')
+        self._params[emitter].value = value
+        self._drop_capability_cache()
+        if self._batch_depth:
+            self._batch_signals[emitter] = value
+            return
+        if self._in_deadband(emitter, value) or self._throttle_signal(emitter):
+            return
+        self._record_signal(emitter, value)
+        self._whisper_signal(self._get_subscribers([emitter]), emitter, value)
 
-        for subscriber in self.subscribers:
-            if (None in self.subscribers[subscriber] or
-                    emitter in self.subscribers[subscriber]):
-                self.whisper(subscriber, msg)
+    def emit_signals(self, signals):
+        """
+        Update the values of multiple emitters and signal all subscribed
+        receivers, sending a single message to each subscriber
 
+        :param dict signals: emitter names and their new values
+        """
+        self._drop_capability_cache()
+        if self._batch_depth:
+            for emitter, value in signals.items():
+                self._params[emitter].value = value
+                self._batch_signals[emitter] = value
+            return
+        sending = {}
+        for emitter, value in signals.items():
+            self._params[emitter].value = value
+            if not (self._in_deadband(emitter, value) or self._throttle_signal(emitter)):
+                self._record_signal(emitter, value)
+                sending[emitter] = value
+        self._whisper_signals(sending)
+
+    def _whisper_signals(self, signals, exclude=None):
+        """
+        Signal the subscribers of multiple emitters, batching the
+        signals for each subscriber
+        """
+        # emitters per subscribing peer
+        peer_emitters = {}
+        for emitter in signals:
+            for record in self._get_subscribers([emitter], exclude=exclude):
+                peer_emitters.setdefault(record, []).append(emitter)
+
+        # peers subscribed to the same emitters get the same message
+        batches = {}
+        for record, emitters in peer_emitters.items():
+            if len(emitters) > 1 and SIGB_EXT in record.exts:
+                batches.setdefault(tuple(emitters), []).append(record)
+            else:
+                for emitter in emitters:
+                    self._whisper_signal([record], emitter, signals[emitter])
+
+        for emitters, peers in batches.items():
+            batch = []
+            for emitter in emitters:
+                value = signals[emitter]
+                if numpy is not None and isinstance(value, numpy.ndarray):
+                    # arrays are always sent in their own frames
+                    self._whisper_array(peers, emitter, value)
+                else:
+                    batch.append([emitter, value])
+            if batch:
+                self._whisper_many(peers, {'SIGB': batch})
+
+    def call_later(self, delay, callback, *args):
+        """
+        Call a callback once from the run loop after a delay
+
+        :param float delay: delay in seconds
+        :param callback: the callable to call with args
+        :return: a ZOCPTimer which can be cancelled
+        """
+        return self._schedule(ZOCPTimer(_clock() + delay, None, callback, args))
+
+    def call_every(self, interval, callback, *args):
+        """
+        Call a callback from the run loop at a fixed interval
+
+        The callback is scheduled at exact multiples of the interval,
+        calls that are missed because the loop was busy are skipped.
+
+        :param float interval: interval in seconds
+        :param callback: the callable to call with args
+        :return: a ZOCPTimer which can be cancelled
+        """
+        return self._schedule(ZOCPTimer(_clock() + interval, interval, callback, args))
+
+    def call_soon_threadsafe(self, callback, *args):
+        """
+        Call a callback from the run loop, can be called from any thread
+
+        :param callback: the callable to call with args
+        """
+        with self._calls_lock:
+            self._calls.append((callback, args))
+            if len(self._calls) == 1:
+                try:
+                    self._wakeup_pipe.send(b'', zmq.NOBLOCK)
+                except zmq.Again:
+                    # the loop is already woken up
+                    pass
 
     #########################################
     # ZRE event methods. These can be overwritten
@@ -612,88 +1378,175 @@ class ZOCP(Pyre):
         # A message coming from a zre node contains:
         # * msg type
         # * msg peer id
+        # * peer name
         # * group (if group type)
         # * the actual message
-        msg = self.recv()
-        type = msg.pop(0).decode('utf-8')
-        peer = uuid.UUID(bytes=msg.pop(0))
-        name = msg.pop(0).decode('utf-8')
-        grp=None
-        if type == "ENTER":
-            # This is giving conflicts when using a poller, in discussion
-            #if not self.peer_header_value(peer, "X-ZOCP"):
-            #    logger.debug("Node is not a ZOCP node")
-            #    return
+        frames = self.inbox.recv_multipart(copy=False)
+        type = frames[0].bytes
+        peer_id = frames[1].bytes
+        record = self._peers.get(peer_id)
+        if record is not None:
+            # the handlers find the record without a lookup
+            self._last_peer = record
+            peer = record.uuid
+            record.messages += 1
+        else:
+            peer = uuid.UUID(bytes=peer_id)
+        name = frames[2].bytes.decode('utf-8')
+        grp = None
+        if type == b"WHISPER":
+            first = 3
+        elif type == b"SHOUT":
+            grp = frames[3].bytes
+            first = 4
+        else:
+            msg = [frame.bytes for frame in frames[3:]]
+            self._handle_zre_event(type, peer_id, peer, name, msg)
+            return
 
-            if not peer in self.peers_capabilities.keys():
-                self.peers_capabilities.update({peer: {}})
+        payload = frames[first].bytes
+        marker = payload[:1]
+        if marker == ARRAY_FRAME_MARKER and len(frames) > first + 1:
+            # keep the array data in its zmq frame so it is never copied
+            msg = [payload, frames[first + 1]]
+        else:
+            if marker == ZLIB_FRAME_MARKER:
+                try:
+                    payload = self._decompress(payload)
+                except (zlib.error, ValueError) as e:
+                    logger.error("ERROR:%s: invalid compressed message from %s: %s" %(self.name(), name, e))
+                    return
+                marker = payload[:1]
+            msg = [payload] + [frame.bytes for frame in frames[first + 1:]]
+        if grp is None:
+            self._notify(self.on_peer_whisper, peer, name, msg)
+        else:
+            self._notify(self.on_peer_shout, peer, name, grp, msg)
 
-            self.peer_get_capability(peer)
-            self.on_peer_enter(peer, name, msg)
+        if marker == SIG_FRAME_MARKER:
+            self._handle_sig_frame(payload, peer, name, grp)
+            return
+        elif marker == ARRAY_FRAME_MARKER:
+            self._handle_array_frame(payload, msg[1], peer, name, grp)
             return
 
-        elif type == "EXIT":
-            if peer in self.subscribers:
-                self.subscribers.pop(peer)
-            if peer in self.subscriptions:
-                self.subscriptions.pop(peer)
-            self.on_peer_exit(peer, name, msg)
-            if peer in self.peers_capabilities:
-                self.peers_capabilities.pop(peer)
+        try:
+            data = self._codecs_by_marker[marker].decode(payload)
+        except Exception as e:
+            logger.error("ERROR:%s: %s in %s, type %s" %(e, msg, type))
             return
 
-        elif type == "JOIN":
+        req_id = data.pop('ID', None) if isinstance(data, dict) else None
+        self._mod_version = data.pop('VER', None) if isinstance(data, dict) else None
+        handlers = self._handlers
+        for method in data:
+            if req_id is not None and method in ('GET', 'SET', 'CALL'):
+                self._handle_request(req_id, method, data[method], peer, name, grp)
+                continue
+            handler = handlers.get(method)
+            if handler is None:
+                handler = self._get_handler(method)
+                if handler is None:
+                    logger.warning("ZOCP :%s: no handler for method %s from %s" %(self.name(), method, name))
+                    continue
+            handler(self, data[method], peer, name, grp)
+        self._mod_version = None
+
+    def _handle_zre_event(self, type, peer_id, peer, name, msg):
+        """
+        Handle the ZRE events not carrying any ZOCP data
+        """
+        if type == b"ENTER":
+            # This is giving conflicts when using a poller, in discussion
+            #if not self.peer_header_value(peer, "X-ZOCP"):
+            #    logger.debug("Node is not a ZOCP node")
+            #    return
+
+            record = self._add_peer(peer)
+            record.name = name
+            if len(msg) > 1:
+                record.address = msg[1].decode('utf-8')
+            if record.capability is None:
+                record.capability = {}
+            headers = self._parse_headers(msg)
+            record.codec = self._select_codec(headers)
+            offered = headers.get("X-ZOCP-CODEC", "").split(",")
+            record.sig_frames = SIG_FRAME in offered
+            record.array_frames = ARRAY_FRAME in offered and numpy is not None
+            record.zlib = ZLIB_FRAME in offered
+            record.exts = frozenset(headers.get("X-ZOCP-EXT", "").split(","))
+
+            # no need to fetch a capability we've seen before
+            cap = self._get_cached_capability(headers.get("X-ZOCP-CAPHASH"))
+            if cap is not None:
+                self._handle_MOD(cap, peer, name, None)
+            else:
+                self.peer_get_capability(peer)
+            self._notify(self.on_peer_enter, peer, name, msg)
+
+        elif type == b"EXIT":
+            record = self._peers.get(peer_id)
+            if record is not None:
+                self._remove_subscriber_peer(record)
+                record.subscriptions = {}
+            self._notify(self.on_peer_exit, peer, name, msg)
+            record = self._peers.pop(peer_id, None)
+            self._last_peer = None
+            if record is not None:
+                self._cancel_requests(record)
+
+        elif type == b"JOIN":
             grp = msg.pop(0)
-            self.on_peer_join(peer, name, grp, msg)
-            return
+            self._notify(self.on_peer_join, peer, name, grp, msg)
 
-        elif type == "LEAVE":
+        elif type == b"LEAVE":
             #if peer in self.subscribers:
             #    self.subscribers.pop(peer)
             #if peer in self.subscriptions:
             #    self.subscriptions.pop(peer)
             grp = msg.pop(0)
-            self.on_peer_leave(peer, name, grp, msg)
-            return
-
-        elif type == "SHOUT":
-            grp = msg.pop(0)
-            self.on_peer_shout(peer, name, grp, msg)
-
-        elif type == "WHISPER":
-            self.on_peer_whisper(peer, name, msg)
-
-        else:
-            return
-
-        try:
-            msg = json.loads(msg.pop(0).decode('utf-8'))
-        except Exception as e:
-            logger.error("ERROR:%s: %s in %s, type %s" %(e, msg, type))
-        else:
-            for method in msg.keys():
-                if method   == 'GET':
-                    self._handle_GET(msg[method], peer, name, grp)
-                elif method == 'SET':
-                    self._handle_SET(msg[method], peer, name, grp)
-                elif method == 'CALL':
-                    self._handle_CALL(msg[method], peer, name, grp)
-                elif method == 'SUB':
-                    self._handle_SUB(msg[method], peer, name, grp)
-                elif method == 'UNSUB':
-                    self._handle_UNSUB(msg[method], peer, name, grp)
-                elif method == 'REP':
-                    self._handle_REP(msg[method], peer, name, grp)
-                elif method == 'MOD':
-                    self._handle_MOD(msg[method], peer, name, grp)
-                elif method == 'SIG':
-                    self._handle_SIG(msg[method], peer, name, grp)
-                else:
-                    try:
-                        func = getattr(self, 'handle_'+method)
-                        func(msg[method])
-                    except:
-                        raise Exception('No %s method on resource:%s: %s' %(method,object))
+            self._notify(self.on_peer_leave, peer, name, grp, msg)
+
+    def _build_handlers(self):
+        """
+        Build the table of handlers for ZOCP methods
+
+        Methods without a built-in handler are dispatched to a
+        handle_<METHOD> method if the node has one. The table holds the
+        functions of the class, not bound methods, so it doesn't keep
+        the node alive.
+        """
+        cls = type(self)
+        self._handlers = {
+            'GET': cls._handle_GET,
+            'SET': cls._handle_SET,
+            'CALL': cls._handle_CALL,
+            'SUB': cls._handle_SUB,
+            'UNSUB': cls._handle_UNSUB,
+            'REP': cls._handle_REP,
+            'MOD': cls._handle_MOD,
+            'SIG': cls._handle_SIG,
+            'SIGB': cls._handle_SIGB,
+            'SIGID': cls._handle_SIGID,
+            'SINCE': cls._handle_SINCE,
+        }
+        for attr in dir(cls):
+            if attr.startswith('handle_'):
+                self._get_handler(attr[len('handle_'):])
+
+    def _get_handler(self, method):
+        """
+        Look up and cache the handle_<METHOD> method for a ZOCP method
+
+        :return: the handler or None if the node has no such method
+        """
+        func = getattr(type(self), 'handle_' + method, None)
+        if not callable(func):
+            return None
+        def handler(node, data, peer, name, grp):
+            func(node, data)
+        self._handlers[method] = handler
+        return handler
 
     def _handle_GET(self, data, peer, name, grp=None):
         """
@@ -701,24 +1554,57 @@ class ZOCP(Pyre):
         else fetch every item requested and return them
         """
         if not data:
-            data = {'MOD': self.get_capability()}
-            self.whisper(peer, json.dumps(data).encode('utf-8'))
+            record = self._get_peer(peer)
+            codec = record.codec
+            self._whisper_payload(record, codec.encode_raw('MOD', self._encoded_capability(codec),
+                                                  extra=self._baseline_version(record)))
             return
-        else:
-            # first is the object to retrieve from
-            # second is the items list of items to retrieve
-            ret = {}
-            for get_item in data:
-                ret[get_item] = self.capability.get(get_item)
-            self.peer_set(peer, data)
-            self.whisper(peer, json.dumps({ 'MOD' :ret}).encode('utf-8'))
+        self._whisper_data(peer, {'MOD': self._get_items(data)})
+
+    def _get_items(self, data):
+        """
+        Return the items of the capability a GET asks for
+        """
+        if not data:
+            return self.get_capability()
+        ret = {}
+        for get_item in data:
+            ret[get_item] = self.capability.get(get_item)
+        return ret
 
     def _handle_SET(self, data, peer, name, grp):
-        self.capability = dict_merge(self.capability, data)
-        self._on_modified(data, peer, name)
+        if not isinstance(data, Mapping):
+            # nodes without the request extension echo the keys of a GET
+            # as a SET
+            logger.warning("ZOCP :%s: ignoring SET of %r from %s" %(self.name(), data, name))
+            return
+        self.capability, diff = dict_merge_diff(self.capability, data)
+        # no need to inform anyone about values we already had
+        if diff:
+            self._on_capability_modified(diff, peer, name)
 
     def _handle_CALL(self, data, peer, name, grp):
-        return
+        try:
+            result = self._call_method(data)
+        except Exception:
+            logger.exception("ZOCP :%s: CALL from %s failed" %(self.name(), name))
+            return
+        if isinstance(result, concurrent.futures.Future):
+            # nobody waits for the result, but failures must not go unnoticed
+            node_name = self.name()
+            result.add_done_callback(lambda future: _log_call_failure(future, node_name, name))
+
+    def _call_method(self, data):
+        """
+        Call a registered method
+
+        :return: the result or a future if the method runs on an executor
+        """
+        method, args = data
+        func, executor = self._methods[method]
+        if executor is None:
+            return func(*args)
+        return executor.submit(func, *args)
 
     def _handle_SUB(self, data, peer, name, grp):
         [emit_peer, emitter, recv_peer, receiver] = data
@@ -743,21 +1629,14 @@ class ZOCP(Pyre):
         if emitter is not None:
             # update subscribers in capability tree
             subscriber = (recv_peer.hex, receiver)
-            subscribers = self.capability[emitter]["subscribers"]
+            subscribers = self._params[emitter].subscribers
             if subscriber not in subscribers:
                 subscribers.append(subscriber)
-                self._on_modified(data={emitter: {"subscribers": subscribers}})
-
-        peer_subscribers = {}
-        if recv_peer in self.subscribers:
-            peer_subscribers = self.subscribers[recv_peer]
-        if not emitter in peer_subscribers:
-            peer_subscribers[emitter] = [receiver]
-        elif not receiver in peer_subscribers[emitter]:
-            peer_subscribers[emitter].append(receiver)
-        self.subscribers[recv_peer] = peer_subscribers
-
-        self.on_peer_subscribed(recv_peer, name, data)
+                self._on_param_modified(emitter, {"subscribers": subscribers})
+
+        self._add_subscriber(recv_peer, emitter, receiver)
+
+        self._notify(self.on_peer_subscribed, recv_peer, name, data)
         return
 
     def _handle_UNSUB(self, data, peer, name, grp):
@@ -782,103 +1661,882 @@ class ZOCP(Pyre):
         if emitter is not None:
             # update subscribers in capability tree
             subscriber = (recv_peer.hex, receiver)
-            subscribers = self.capability[emitter]["subscribers"]
+            subscribers = self._params[emitter].subscribers
             if subscriber in subscribers:
                 subscribers.remove(subscriber)
-                self._on_modified(data={emitter: {"subscribers": subscribers}})
-
-        if (recv_peer in self.subscribers and
-                emitter in self.subscribers[recv_peer] and
-                receiver in self.subscribers[recv_peer][emitter]):
-            self.subscribers[recv_peer][emitter].remove(receiver)
-            if not any(self.subscribers[recv_peer][emitter]):
-                self.subscribers[recv_peer].pop(emitter)
-            if not any(self.subscribers[recv_peer]):
-                self.subscribers.pop(recv_peer)
-
-            self.on_peer_unsubscribed(peer, name, data)
+                self._on_param_modified(emitter, {"subscribers": subscribers})
+
+        if self._remove_subscriber(recv_peer, emitter, receiver):
+            self._notify(self.on_peer_unsubscribed, peer, name, data)
         return
 
     def _handle_REP(self, data, peer, name, grp):
-        return
+        """
+        Resolve the future of the request a REP [id, result, error]
+        replies to
+        """
+        request = self._requests.pop(data[0], None)
+        if request is None:
+            # the request timed out or the peer left
+            return
+        req_peer, method, future, timer, req_data = request
+        if timer is not None:
+            timer.cancel()
+        if future.done():
+            return
+        if len(data) > 2 and data[2] is not None:
+            future.set_exception(ZOCPRequestError(data[2]))
+            return
+        result = data[1]
+        if method == 'GET' and result:
+            if not req_data:
+                self._cache_capability(result)
+            self._handle_MOD(result, peer, name, grp)
+        future.set_result(result)
+
+    def _handle_request(self, req_id, method, data, peer, name, grp):
+        """
+        Handle a GET, SET or CALL carrying a request id and REP the
+        result
+        """
+        try:
+            if method == 'GET' and not data:
+                record = self._get_peer(peer)
+                codec = record.codec
+                self._whisper_payload(record, codec.encode_raw('REP', self._encoded_capability(codec), [req_id],
+                                                      extra=self._baseline_version(record)))
+                return
+            elif method == 'GET':
+                result = self._get_items(data)
+            elif method == 'CALL':
+                result = self._call_method(data)
+            elif method == 'SET' and not isinstance(data, Mapping):
+                raise TypeError("%r is not a mapping" %(data,))
+            else:
+                result = self._handlers[method](self, data, peer, name, grp)
+        except Exception as e:
+            logger.exception("ZOCP :%s: %s from %s failed" %(self.name(), method, name))
+            self._whisper_data(peer, {'REP': [req_id, None, "%s: %s" %(type(e).__name__, e)]})
+            return
+        if isinstance(result, concurrent.futures.Future):
+            # the executor finishes the call in another thread
+            result.add_done_callback(lambda future: self.call_soon_threadsafe(
+                self._reply_future, req_id, future, peer, name))
+            return
+        self._reply(req_id, result, peer, name)
+
+    def _reply_future(self, req_id, future, peer, name):
+        """
+        REP the result of a call which ran on an executor
+        """
+        if peer not in self.peers_capabilities:
+            # the caller left
+            return
+        e = future.exception()
+        if e is not None:
+            logger.error("ZOCP :%s: CALL from %s failed: %s" %(self.name(), name, e))
+            self._whisper_data(peer, {'REP': [req_id, None, "%s: %s" %(type(e).__name__, e)]})
+            return
+        self._reply(req_id, future.result(), peer, name)
+
+    def _reply(self, req_id, result, peer, name):
+        """
+        REP the result of a request, or the error if the result can't
+        be encoded
+        """
+        try:
+            self._whisper_data(peer, {'REP': [req_id, result]})
+        except Exception as e:
+            logger.error("ZOCP :%s: cannot reply to %s: %s" %(self.name(), name, e))
+            self._whisper_data(peer, {'REP': [req_id, None, "%s: %s" %(type(e).__name__, e)]})
 
     def _handle_MOD(self, data, peer, name, grp):
-        self.peers_capabilities[peer] = dict_merge(self.peers_capabilities.get(peer), data)
-        self.on_peer_modified(peer, name, data)
+        if not isinstance(data, Mapping):
+            logger.warning("ZOCP :%s: ignoring MOD of %r from %s" %(self.name(), data, name))
+            return
+        record = self._add_peer(peer)
+        if self._mod_version is not None:
+            self._check_version(record, self._mod_version)
+        record.capability, diff = dict_merge_diff(record.capability, data)
+        param_index(record.capability, record.params, diff)
+        if record.legacy_gets:
+            self._resolve_legacy_get(record, data)
+        if diff:
+            self._notify(self.on_peer_modified, peer, name, diff)
 
     def _handle_SIG(self, data, peer, name, grp):
         [emitter, value] = data
-        if emitter in self.peers_capabilities[peer]:
-            self.peers_capabilities[peer][emitter].update({'value': value})
+        record = self._get_peer(peer)
+        record.signals += 1
+        param = record.params.get(emitter)
+        if param is not None:
+            param.value = value
+
+        subscription = record.subscriptions
+        if emitter in subscription:
+            receivers = subscription[emitter]
 
-        if peer in self.subscriptions:
-            subscription = self.subscriptions[peer]
-            if emitter in subscription:
-                receivers = subscription[emitter]
+            # add a list of sensors on this node receiving the signal
+            data.append(receivers)
 
-                # add a list of sensors on this node receiving the signal
-                data.append(receivers)
+            for receiver in receivers:
+                # propagate the signal if it changes the value of this node
+                if receiver is not None and not values_equal(self._params[receiver].value, value):
+                    self.emit_signal(receiver, value)
 
-                for receiver in receivers:
-                    # propagate the signal if it changes the value of this node
-                    if receiver is not None and self.capability[receiver]['value'] != value:
-                        self.emit_signal(receiver, value)
+        if None in subscription or emitter in subscription:
+            self._notify(self.on_peer_signaled, peer, name, data)
 
-            if None in subscription or emitter in subscription:
-                self.on_peer_signaled(peer, name, data)
+    def _handle_SINCE(self, data, peer, name, grp):
+        """
+        Send the modifications after version data to peer, or the
+        complete capability if they're no longer logged
+        """
+        if not self._delta_log or data < self._delta_log[0][0] - 1:
+            self._handle_GET(None, peer, name, grp)
+            return
+        diff = {}
+        for version, delta in self._delta_log:
+            if version > data:
+                diff = dict_merge(diff, json_codec.decode(delta))
+        msg = {'MOD': diff}
+        msg.update(self._baseline_version(self._get_peer(peer)) or {})
+        self._whisper_data(peer, msg)
+
+    def _handle_SIGB(self, data, peer, name, grp):
+        for signal in data:
+            self._handle_SIG(list(signal), peer, name, grp)
+
+    def _handle_SIGID(self, data, peer, name, grp):
+        [index, emitter] = data
+        self._get_peer(peer).sig_names[index] = emitter
+
+    def _handle_sig_frame(self, payload, peer, name, grp):
+        """
+        Decode a typed signal frame and handle it as a SIG
+        """
+        try:
+            marker, code, index = _sig_frame_header.unpack_from(payload)
+            value_struct, vector = _sig_frame_decoders[code]
+            value = value_struct.unpack_from(payload, _sig_frame_header.size)
+            emitter = self._get_peer(peer).sig_names[index]
+        except (struct.error, KeyError) as e:
+            logger.error("ERROR:%s: invalid signal frame from %s: %s" %(self.name(), name, e))
+            return
+        value = list(value) if vector else value[0]
+        self._handle_SIG([emitter, value], peer, name, grp)
+
+    def _handle_array_frame(self, payload, frame, peer, name, grp):
+        """
+        Handle an array signal as a SIG, the value is a read-only view
+        on the received zmq frame
+        """
+        try:
+            [emitter, dtype, shape] = json.loads(payload[1:].decode('utf-8'))
+            value = numpy.frombuffer(frame.buffer, dtype=dtype).reshape(shape)
+        except Exception as e:
+            logger.error("ERROR:%s: invalid array frame from %s: %s" %(self.name(), name, e))
+            return
+        self._handle_SIG([emitter, value], peer, name, grp)
 
     def _on_modified(self, data, peer=None, name=None):
-        if self._cur_obj_keys:
+        if self._cur_obj_keys and data is not self.capability:
             # the last key in the _cur_obj_keys list equals 
             # the first in data so skip the last key
             for key in self._cur_obj_keys[::-1]:
                 new_data = {}
                 new_data[key] = data
                 data = new_data
-        self.on_modified(peer, name, data)
-
-        if len(data) == 1:
-            # if the only modification is a value change,
-            # emit a SIG instead of a MOD
-            name = list(data.keys())[0]
-            if len(data[name]) == 1 and 'value' in data[name]:
-                msg = json.dumps({'SIG': [name, data[name]['value']]}).encode('utf-8')
-                for subscriber in self.subscribers:
-                    # no need to send the signal to the node that
-                    # modified the value
-                    if subscriber != peer and (
-                            None in self.subscribers[subscriber] or
-                            name in self.subscribers[subscriber]):
-                        self.whisper(subscriber, msg)
-                data = {}
+        self._on_capability_modified(data, peer, name)
+
+    def _on_param_modified(self, path, data):
+        """
+        Publish a modification of the variable at a dotted path
+        """
+        keys = [path] if path in self.capability else path.split(".")
+        for key in keys[::-1]:
+            data = {key: data}
+        self._on_capability_modified(data)
+
+    def _on_capability_modified(self, data, peer=None, name=None):
+        """
+        Index and publish a modification relative to the capability root
+        """
+        self._drop_capability_cache()
+        if data is self.capability:
+            self._params = param_index(self.capability)
+        else:
+            param_index(self.capability, self._params, data)
+        if self._batch_depth:
+            # data can be part of the capability, merge a copy
+            key = (peer, name)
+            self._batch_modified[key] = dict_merge(self._batch_modified.get(key, {}), copy.deepcopy(data))
+            return
+        self._publish_modified(data, peer, name)
+
+    def _publish_modified(self, data, peer, name):
+        """
+        Version a modification and inform on_modified and the subscribers
+        """
+        self._version += 1
+        self._log_delta(data)
+        self._notify(self.on_modified, peer, name, data)
+
+        items, other = self._param_items(data)
+        if items and not other and all(len(item) == 1 and 'value' in item
+                                       for item in items.values()):
+            # if the only modifications are value changes,
+            # emit SIGs instead of a MOD
+            # no need to send the signal to the node that
+            # modified the value
+            if len(items) == 1:
+                path, item = items.popitem()
+                peers = self._get_subscribers([path], exclude=peer)
+                self._whisper_signal(peers, path, item['value'])
+            else:
+                self._whisper_signals(dict((path, item['value']) for path, item in items.items()), exclude=peer)
+            data = {}
 
         if any(data):
-            msg = json.dumps({ 'MOD' :data}).encode('utf-8')
-            for subscriber in self.subscribers:
-                # inform node that are subscribed to one or more
-                # updated capabilities that they have changed
-                if subscriber != peer and (
-                        None in self.subscribers[subscriber] or
-                        len(set(self.subscribers[subscriber]) & set(data)) > 0):
-                    self.whisper(subscriber, msg)
+            # inform node that are subscribed to one or more
+            # updated capabilities that they have changed
+            self._whisper_mod(self._get_subscribers(itertools.chain(data, items), exclude=peer), data)
+
+    def _param_items(self, data):
+        """
+        Find the items of a modification changing variables
+
+        :return: the items by the dotted path of their variable, and\
+                whether the modification changes anything else
+        """
+        items = {}
+        other = False
+        stack = [("", data)]
+        while stack:
+            prefix, node = stack.pop()
+            for key, value in node.items():
+                path = prefix + key
+                if not isinstance(value, _mappings) or not value:
+                    other = True
+                elif path in self._params:
+                    items[path] = value
+                else:
+                    stack.append((path + ".", value))
+        return items, other
 
-    def run_once(self, timeout=None):
+    def _log_delta(self, data):
+        """
+        Keep a modification to answer SINCE requests, encoded as it
+        must not change with the capability
+        """
+        log = self._delta_log
+        if data is self.capability:
+            # nothing before a complete capability is needed, peers
+            # missing it GET the capability
+            log.clear()
+            self._delta_log_used = 0
+            return
+        delta = json_codec.encode_value(data)
+        log.append((self._version, delta))
+        self._delta_log_used += len(delta)
+        while len(log) > self.delta_log_size or (
+                len(log) > 1 and self._delta_log_used > self.delta_log_bytes):
+            self._delta_log_used -= len(log.popleft()[1])
+
+    def _get_peer(self, peer):
+        """
+        Return the record of a peer, a blank one if the peer is unknown
+        """
+        record = self._last_peer
+        if record is None or record.uuid is not peer:
+            record = self._peers.get(peer.bytes)
+            if record is None:
+                return Peer(peer)
+            self._last_peer = record
+        return record
+
+    def _add_peer(self, peer):
+        """
+        Return the record of a peer, creating it if it's new
+        """
+        record = self._peers.get(peer.bytes)
+        if record is None:
+            record = self._peers[peer.bytes] = Peer(peer)
+        return record
+
+    def _add_subscriber(self, recv_peer, emitter, receiver):
+        """
+        Register a receiver on a peer as subscriber of one of our emitters
+        """
+        record = self._add_peer(recv_peer)
+        receivers = record.subscribers.setdefault(emitter, [])
+        if not receiver in receivers:
+            receivers.append(receiver)
+        if emitter is None:
+            self._wildcard_subscribers.add(record)
+        else:
+            self._emitter_subscribers.setdefault(emitter, set()).add(record)
+
+    def _remove_subscriber(self, recv_peer, emitter, receiver):
+        """
+        Unregister a receiver on a peer as subscriber of one of our emitters
+
+        :return: True if the receiver was subscribed
+        """
+        record = self._peers.get(recv_peer.bytes)
+        receivers = record.subscribers.get(emitter) if record is not None else None
+        if receivers is None or receiver not in receivers:
+            return False
+        receivers.remove(receiver)
+        if not receivers:
+            record.subscribers.pop(emitter)
+            self._unindex_subscriber(record, emitter)
+        return True
+
+    def _remove_subscriber_peer(self, record):
+        """
+        Unregister all subscriptions of a peer to our emitters
+        """
+        for emitter in record.subscribers:
+            self._unindex_subscriber(record, emitter)
+        record.subscribers = {}
+
+    def _unindex_subscriber(self, record, emitter):
+        if emitter is None:
+            self._wildcard_subscribers.discard(record)
+            return
+        peers = self._emitter_subscribers.get(emitter)
+        if peers is not None:
+            peers.discard(record)
+            if not peers:
+                self._emitter_subscribers.pop(emitter)
+
+    def _get_subscribers(self, emitters, exclude=None):
+        """
+        Return the set of records of the peers subscribed to any of the
+        emitters
+
+        :param emitters: iterable of emitter names
+        :param uuid exclude: peer to leave out
+        """
+        peers = set(self._wildcard_subscribers)
+        for emitter in emitters:
+            subscribed = self._emitter_subscribers.get(emitter)
+            if subscribed:
+                peers.update(subscribed)
+        if exclude is not None:
+            peers.discard(self._peers.get(exclude.bytes))
+        return peers
+
+    def _parse_headers(self, msg):
+        """
+        Return the ZRE headers of a peer as a dict
+
+        :param list msg: the remainder of the ENTER message, the first\
+                    frame holds the JSON encoded ZRE headers of the peer
+        """
+        try:
+            return dict(json.loads(msg[0].decode('utf-8')))
+        except Exception:
+            return {}
+
+    def _select_codec(self, headers):
+        """
+        Pick the codec to use for sending to a peer
+
+        :param dict headers: the ZRE headers of the peer
+        :return: our most preferred codec the peer also speaks
+        """
+        offered = headers.get("X-ZOCP-CODEC")
+        if offered:
+            offered = offered.split(",")
+            for codec in self.codecs:
+                if codec.name in offered:
+                    return codec
+        # nodes not advertising codecs only speak JSON
+        return json_codec
+
+    def _request(self, peer, method, data, callback, timeout):
+        """
+        Send a GET, SET or CALL to peer and track it until the REP
+
+        Peers without the request extension never reply, a GET to them
+        resolves on the first MOD holding the requested keys, a SET or
+        CALL resolves once sent.
+        """
+        future = concurrent.futures.Future()
+        if callback is not None:
+            future.add_done_callback(callback)
+        if REQ_EXT not in self._get_peer(peer).exts:
+            self._whisper_data(peer, {method: data})
+            if method == 'GET':
+                record = self._add_peer(peer)
+                record.legacy_gets.append((data, future))
+                if timeout is not None:
+                    self.call_later(timeout, self._expire_legacy_get, record, future)
+            else:
+                future.set_result(None)
+            return future
+        req_id = next(self._request_ids)
+        timer = None
+        if timeout is not None:
+            timer = self.call_later(timeout, self._expire_request, req_id)
+        self._requests[req_id] = [peer, method, future, timer, data]
+        self._whisper_data(peer, {method: data, 'ID': req_id})
+        return future
+
+    def _expire_request(self, req_id):
+        request = self._requests.pop(req_id, None)
+        if request is not None and not request[2].done():
+            request[2].set_exception(concurrent.futures.TimeoutError(
+                "no reply to %s %s" %(request[1], req_id)))
+
+    def _expire_legacy_get(self, record, future):
+        pending = record.legacy_gets
+        for item in pending:
+            if item[1] is future:
+                pending.remove(item)
+                break
+        if not future.done():
+            future.set_exception(concurrent.futures.TimeoutError("no reply to GET"))
+
+    def _resolve_legacy_get(self, record, data):
+        """
+        Resolve the oldest GET to a peer without the request extension
+        which is answered by the MOD data
+        """
+        pending = record.legacy_gets
+        for item in pending:
+            keys, future = item
+            if future.done():
+                continue
+            if not keys or all(key in data for key in keys):
+                pending.remove(item)
+                future.set_result(dict((key, data[key]) for key in keys) if keys else data)
+                break
+        while pending and pending[0][1].done():
+            pending.popleft()
+
+    def _cancel_requests(self, record):
+        """
+        Cancel the pending requests to a peer which left
+        """
+        for req_id, request in list(self._requests.items()):
+            if request[0] == record.uuid:
+                del self._requests[req_id]
+                if request[3] is not None:
+                    request[3].cancel()
+                request[2].cancel()
+        while record.legacy_gets:
+            keys, future = record.legacy_gets.popleft()
+            future.cancel()
+
+    def _update_capability_hash(self):
+        """
+        Advertise the hash of the capability if it was modified
+        """
+        if self._capability_hash_dirty:
+            self._capability_hash_dirty = False
+            self.set_header("X-ZOCP-CAPHASH", canonical_capability(self.get_capability())[1])
+
+    def _cache_capability(self, cap):
+        """
+        Store the complete capability of a peer by its hash
+        """
+        text, caphash = canonical_capability(cap)
+        self._store_peer_capability(caphash, text)
+        if self._peer_cap_dir:
+            path = os.path.join(self._peer_cap_dir, caphash + ".json")
+            try:
+                if not os.path.exists(path):
+                    with open(path, 'wb') as f:
+                        f.write(text)
+            except (IOError, OSError) as e:
+                logger.warning("ZOCP :%s: can't store capability: %s" %(self.name(), e))
+
+    def _get_cached_capability(self, caphash):
+        """
+        :return: the capability with the hash, or None if it is unknown
+        """
+        if not caphash or len(caphash) != 40:
+            return None
+        try:
+            int(caphash, 16)
+        except ValueError:
+            # not a hash, never use it as a file name
+            return None
+        text = self._peer_cap_store.get(caphash)
+        if text is None and self._peer_cap_dir:
+            path = os.path.join(self._peer_cap_dir, caphash + ".json")
+            try:
+                with open(path, 'rb') as f:
+                    text = f.read()
+            except (IOError, OSError):
+                return None
+            if hashlib.sha1(text).hexdigest() != caphash:
+                return None
+        if text is None:
+            return None
+        self._store_peer_capability(caphash, text)
+        return json.loads(text.decode('utf-8'))
+
+    def _store_peer_capability(self, caphash, text):
+        """
+        Keep an encoded capability in memory as the most recently used,
+        dropping the least recently used beyond capability_cache_size
+        """
+        store = self._peer_cap_store
+        store.pop(caphash, None)
+        store[caphash] = text
+        while len(store) > self.capability_cache_size:
+            store.popitem(last=False)
+
+    def _whisper_mod(self, peers, data):
+        """
+        Whisper a MOD to peer records, with the version and the version of
+        the previous MOD to the peer for those supporting versions
+        """
+        others = []
+        encoded = {}
+        for record in peers:
+            if VER_EXT not in record.exts:
+                others.append(record)
+                continue
+            codec = record.codec
+            raw = encoded.get(codec.name)
+            if raw is None:
+                raw = encoded[codec.name] = codec.encode_value(data)
+            prev = record.mod_version
+            record.mod_version = self._version
+            self._whisper_payload(record, codec.encode_raw('MOD', raw, extra={'VER': [self._version, prev]}))
+        if others:
+            self._whisper_many(others, {'MOD': data})
+
+    def _baseline_version(self, record):
+        """
+        Return the VER item for a message holding the capability as of
+        the current version, None if the peer doesn't support versions
+        """
+        if VER_EXT not in record.exts:
+            return None
+        record.mod_version = self._version
+        return {'VER': [self._version, None]}
+
+    def _check_version(self, record, ver):
+        """
+        Check the VER [version, previous version] of a MOD from a peer for
+        missed modifications and request them with SINCE
+        """
+        version, prev = ver
+        known = record.version
+        record.version = version
+        if prev is not None and known is not None and prev != known:
+            logger.warning("ZOCP :%s: missed modifications %s to %s of peer %s" %(self.name(), known, prev, record.uuid))
+            self._whisper_payload(record, record.codec.encode({'SINCE': known}))
+
+    def _encoded_capability(self, codec):
+        """
+        Return the capability encoded by codec, encoding it only once
+        until it is modified
+        """
+        raw = self._capability_cache.get(codec.name)
+        if raw is None:
+            raw = self._capability_cache[codec.name] = codec.encode_value(self.get_capability())
+        return raw
+
+    def _whisper_data(self, peer, data):
+        """
+        Encode data with the codec of the peer and whisper it
+        """
+        record = self._get_peer(peer)
+        self._whisper_payload(record, record.codec.encode(data))
+
+    def _whisper_payload(self, record, payload):
+        """
+        Whisper an encoded message to a peer record, compressed if it's
+        large and the peer accepts it
+        """
+        if record.zlib:
+            payload = self._compress(payload)
+        self.whisper(record.uuid, payload)
+
+    def _compress(self, payload):
+        if self.compress_threshold is None or len(payload) < self.compress_threshold:
+            return payload
+        compressor = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS, 8,
+                                      zlib.Z_DEFAULT_STRATEGY, _zlib_dict)
+        return ZLIB_FRAME_MARKER + compressor.compress(payload) + compressor.flush()
+
+    def _decompress(self, payload):
+        decompressor = zlib.decompressobj(zlib.MAX_WBITS, _zlib_dict)
+        data = decompressor.decompress(memoryview(payload)[1:], ZLIB_MAX_SIZE)
+        if decompressor.unconsumed_tail:
+            raise ValueError("message exceeds %d bytes" % ZLIB_MAX_SIZE)
+        return data
+
+    def _whisper_many(self, peers, data):
+        """
+        Whisper data to multiple peer records, encoding it only once per
+        codec
+        """
+        encoded = {}
+        for record in peers:
+            codec = record.codec
+            key = (codec.name, record.zlib)
+            msg = encoded.get(key)
+            if msg is None:
+                msg = encoded.get((codec.name, False))
+                if msg is None:
+                    msg = encoded[(codec.name, False)] = codec.encode(data)
+                if key[1]:
+                    msg = encoded[key] = self._compress(msg)
+            self.whisper(record.uuid, msg)
+
+    def _encode_sig_frame(self, emitter, value):
+        """
+        Pack a signal into a typed frame based on the typeHint of the emitter
+
+        :return: the frame and the emitter index, or None if the value\
+                cannot be packed
+        """
+        encoder = _sig_frame_encoders.get(self._params[emitter].typeHint)
+        if encoder is None:
+            return None
+        code, frame, vector = encoder
+        index = self._sig_index.get(emitter)
+        if index is None:
+            if len(self._sig_index) > 0xffff:
+                return None
+            index = self._sig_index[emitter] = len(self._sig_index)
+        try:
+            if vector:
+                return frame.pack(SIG_FRAME_MARKER, code, index, *value), index
+            return frame.pack(SIG_FRAME_MARKER, code, index, value), index
+        except (struct.error, TypeError):
+            # value doesn't match its typeHint, send it using the codec
+            return None
+
+    def _whisper_signal(self, peers, emitter, value):
+        """
+        Whisper a SIG to multiple peer records, using a typed signal frame
+        for peers which accept them
+        """
+        if numpy is not None and isinstance(value, numpy.ndarray):
+            self._whisper_array(peers, emitter, value)
+            return
+
+        encoded = None
+        if any(record.sig_frames for record in peers):
+            encoded = self._encode_sig_frame(emitter, value)
+        if encoded is None:
+            self._whisper_many(peers, {'SIG': [emitter, value]})
+            return
+
+        frame, index = encoded
+        others = []
+        for record in peers:
+            if not record.sig_frames:
+                others.append(record)
+                continue
+            if index not in record.sig_announced:
+                self._whisper_payload(record, record.codec.encode({'SIGID': [index, emitter]}))
+                record.sig_announced.add(index)
+            self.whisper(record.uuid, frame)
+        if others:
+            self._whisper_many(others, {'SIG': [emitter, value]})
+
+    def _in_deadband(self, emitter, value):
+        """
+        Apply the deadband of an emitter to a new signal
+
+        :return: True if the value is within the deadband of the last\
+                sent value and must not be sent
+        """
+        deadband = getattr(self._params[emitter], 'deadband', None)
+        if not deadband:
+            return False
+        last = self._last_signal.get(emitter)
+        if last is not None:
+            relative = hasattr(deadband, 'endswith') and deadband.endswith('%')
+            try:
+                if isinstance(value, (list, tuple)):
+                    if len(value) != len(last):
+                        raise TypeError("size changed")
+                    components = zip(value, last)
+                else:
+                    components = [(value, last)]
+                for new, old in components:
+                    if relative:
+                        band = abs(old) * float(deadband[:-1]) / 100
+                    else:
+                        band = deadband
+                    if abs(new - old) > band:
+                        break
+                else:
+                    return True
+            except (TypeError, ValueError):
+                # not a numeric value, always send it
+                pass
+        return False
+
+    def _record_signal(self, emitter, value):
+        """
+        Remember a sent value of an emitter as the reference of its
+        deadband
+        """
+        if getattr(self._params[emitter], 'deadband', None):
+            if isinstance(value, list):
+                value = tuple(value)
+            self._last_signal[emitter] = value
+
+    def _throttle_signal(self, emitter):
+        """
+        Apply the maxRate of an emitter to a new signal
+
+        Within a rate window only the newest value is kept, it is sent by
+        _flush_signal when the window closes.
+
+        :return: True if the signal must not be sent now
+        """
+        max_rate = getattr(self._params[emitter], 'maxRate', None)
+        if not max_rate:
+            return False
+        now = _clock()
+        throttled = self._throttled.get(emitter)
+        if throttled is not None and now < throttled[0]:
+            if not throttled[1]:
+                throttled[1] = True
+                self.call_later(throttled[0] - now, self._flush_signal, emitter)
+            return True
+        self._throttled[emitter] = [now + 1.0 / max_rate, False]
+        return False
+
+    def _flush_signal(self, emitter):
+        """
+        Send the pending value of a throttled emitter when its rate
+        window has closed
+        """
+        throttled = self._throttled.pop(emitter, None)
+        param = self._params.get(emitter)
+        if throttled is None or not throttled[1] or param is None:
+            return
+        # sending the value starts a new rate window
+        max_rate = getattr(param, 'maxRate', None) or 1.0
+        self._throttled[emitter] = [_clock() + 1.0 / max_rate, False]
+        self._record_signal(emitter, param.value)
+        self._whisper_signal(self._get_subscribers([emitter]), emitter, param.value)
+
+    def _schedule(self, timer):
+        heapq.heappush(self._timers, (timer.deadline, next(self._timer_seq), timer))
+        return timer
+
+    def _run_timers(self):
+        """
+        Call the callbacks of all timers which are due
+        """
+        now = _clock()
+        while self._timers and self._timers[0][0] <= now:
+            deadline, seq, timer = heapq.heappop(self._timers)
+            if timer.cancelled:
+                continue
+            if timer.interval:
+                # skip intervals we missed to stay on the original grid
+                timer.deadline += timer.interval * max(1, int((now - deadline) / timer.interval) + 1)
+                self._schedule(timer)
+            timer.callback(*timer.args)
+
+    def _get_timeout(self, timeout):
+        """
+        Limit a poll timeout in milliseconds to the first timer deadline
+        """
+        while self._timers and self._timers[0][2].cancelled:
+            heapq.heappop(self._timers)
+        if not self._timers:
+            return timeout
+        wait = max(0, int((self._timers[0][0] - _clock()) * 1000 + 1))
+        if timeout is None or timeout < 0:
+            return wait
+        return min(timeout, wait)
+
+    def _whisper_array(self, peers, emitter, value):
+        """
+        Whisper an array signal as a header and a raw buffer frame to
+        peer records which accept them
+        """
+        others = [record for record in peers if not record.array_frames]
+        if len(others) < len(peers):
+            value = numpy.ascontiguousarray(value)
+            header = ARRAY_FRAME_MARKER + json.dumps(
+                [emitter, value.dtype.str, value.shape]).encode('utf-8')
+            for record in peers:
+                if record.array_frames:
+                    self.whisper(record.uuid, [header, value])
+        if others:
+            self._whisper_many(others, {'SIG': [emitter, value]})
+
+    def run_once(self, timeout=None, max_messages=None, max_time_ms=None):
         """
         Run one iteration of getting ZOCP events
 
         If timeout is None it will block until an
-        event has been received. If 0 it will return instantly
+        event has been received or a timer is due. If 0 it will return
+        instantly
 
         The timeout is in milliseconds
+
+        :param int max_messages: maximum number of messages to handle
+        :param float max_time_ms: stop handling messages after this many\
+                    milliseconds
+        :return: True if messages are left because a limit was reached
         """
         self._running = True
-        items = dict(self.poller.poll(timeout))
-        while(len(items) > 0):
-            for fd, ev in items.items():
-                if self.inbox == fd and ev == zmq.POLLIN:
-                    self.get_message()
-            # just q quick query
-            items = dict(self.poller.poll(0))
+        items = dict(self.poller.poll(self._get_timeout(timeout)))
+        return self._handle_events(items, max_messages, max_time_ms)
+
+    def _handle_events(self, items, max_messages=None, max_time_ms=None):
+        """
+        Handle the messages, calls and timers due after a poll
+
+        :param dict items: the events of the poll by socket
+        :return: True if messages are left because a limit was reached
+        """
+        if max_time_ms is not None:
+            end = _clock() + max_time_ms / 1000.0
+        count = 0
+        pending = False
+        if items.get(self.inbox, 0) & zmq.POLLIN:
+            while True:
+                if ((max_messages is not None and count >= max_messages) or
+                        (max_time_ms is not None and _clock() >= end)):
+                    pending = True
+                    break
+                self.get_message()
+                count += 1
+                # just a quick query, no need to poll
+                if not self.inbox.getsockopt(zmq.EVENTS) & zmq.POLLIN:
+                    break
+        if items.get(self._wakeup, 0) & zmq.POLLIN:
+            self._run_calls()
+        self._run_timers()
+        return pending
+
+    def _notify(self, callback, *args):
+        """
+        Call an on_* event method, overridden to deliver events elsewhere
+        """
+        callback(*args)
+
+    def _run_calls(self):
+        """
+        Run the callbacks queued by call_soon_threadsafe
+        """
+        with self._calls_lock:
+            calls = list(self._calls)
+            self._calls.clear()
+            while self._wakeup.getsockopt(zmq.EVENTS) & zmq.POLLIN:
+                self._wakeup.recv()
+        for callback, args in calls:
+            callback(*args)
 
     def run(self, timeout=None):
         """
@@ -887,11 +2545,7 @@ class ZOCP(Pyre):
         self._running = True
         while(self._running):
             try:
-                items = dict(self.poller.poll(timeout))
-                while(len(items) > 0):
-                    for fd, ev in items.items():
-                        if self.inbox == fd and ev == zmq.POLLIN:
-                            self.get_message()
+                self.run_once(timeout)
             except (KeyboardInterrupt, SystemExit):
                 break
         self.stop()
@@ -899,6 +2553,112 @@ class ZOCP(Pyre):
     #def __del__(self):
     #    self.stop()
 
+class _Batch(object):
+    """
+    Context manager returned by ZOCP.batch
+    """
+    def __init__(self, node):
+        self.node = node
+
+    def __enter__(self):
+        self.node._begin_batch()
+        return self.node
+
+    def __exit__(self, *exc_info):
+        self.node._end_batch()
+        return False
+
+class NodeGroup(object):
+    """
+    Runs many ZOCP nodes from a single poller
+
+    Every node gets a turn of at most max_messages messages before the
+    next node with messages is handled, starting with a different node
+    each round.
+
+    :param list nodes: the nodes to run
+    :param int max_messages: maximum number of messages handled per node\
+                in a turn
+    """
+    def __init__(self, nodes=(), max_messages=10):
+        self.max_messages = max_messages
+        self.nodes = []
+        self.poller = zmq.Poller()
+        self._next = 0
+        self._running = False
+        for node in nodes:
+            self.add(node)
+
+    def add(self, node):
+        """
+        Add a node to the group
+        """
+        self.nodes.append(node)
+        self.poller.register(node.inbox, zmq.POLLIN)
+        self.poller.register(node._wakeup, zmq.POLLIN)
+
+    def remove(self, node):
+        """
+        Remove a node from the group, the node is not stopped
+        """
+        self.nodes.remove(node)
+        self.poller.unregister(node.inbox)
+        self.poller.unregister(node._wakeup)
+
+    def start(self):
+        """
+        Start all nodes
+        """
+        for node in self.nodes:
+            node.start()
+
+    def stop(self):
+        """
+        Stop all nodes, when running the nodes are stopped as soon as
+        run returns
+        """
+        if self._running:
+            self._running = False
+            return
+        for node in self.nodes:
+            node.stop()
+
+    def run_once(self, timeout=None):
+        """
+        Run one iteration of getting ZOCP events for all nodes
+
+        :param int timeout: milliseconds to wait for events, None blocks\
+                until an event has been received or a timer is due
+        :return: True if messages are left because a node used its turn
+        """
+        for node in self.nodes:
+            timeout = node._get_timeout(timeout)
+        items = dict(self.poller.poll(timeout))
+        count = len(self.nodes)
+        if not count:
+            return False
+        start = self._next % count
+        self._next = start + 1
+        pending = False
+        for node in self.nodes[start:] + self.nodes[:start]:
+            node._running = True
+            if node._handle_events(items, self.max_messages):
+                pending = True
+        return pending
+
+    def run(self, timeout=None):
+        """
+        Run the ZOCP loop of all nodes until stopped
+        """
+        self._running = True
+        while self._running:
+            try:
+                self.run_once(timeout)
+            except (KeyboardInterrupt, SystemExit):
+                break
+        self._running = False
+        self.stop()
+
 if __name__ == '__main__':
 
     z = ZOCP("ZOCP-Test")
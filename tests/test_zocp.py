@@ -3,12 +3,36 @@ import zocp
 import zmq
 import time
 import sys
+import json
+import uuid
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import asyncio
+    from asynczocp import AsyncZOCP
+except (ImportError, SyntaxError):
+    AsyncZOCP = None
+
+from threadedzocp import ThreadedZOCP
 
 if sys.version.startswith('3'):
     unicode = str
 
 
+class HookNode(zocp.ZOCP):
+
+    def __init__(self, *args, **kwargs):
+        super(HookNode, self).__init__(*args, **kwargs)
+        self.pings = []
+
+    def handle_PING(self, data):
+        self.pings.append(data)
+
+
 class ZOCPTest(unittest.TestCase):
     
     def setUp(self, *args, **kwargs):
@@ -41,6 +65,33 @@ class ZOCPTest(unittest.TestCase):
         self.assertIn(id1, peers)
     # end test_peers
 
+    def test_peer_records(self):
+        self.node1.register_float("TestEmitFloat", 1.0, 'rwe')
+        self.node2.register_float("TestRecvFloat", 1.0, 'rws')
+        self.node1.run_once(0)
+        self.node2.run_once(0)
+        id1 = self.node1.uuid()
+        id2 = self.node2.uuid()
+        record = self.node2._peers[id1.bytes]
+        self.assertEqual("node1", record.name)
+        self.assertEqual(self.node2.peer_address(id1), record.address)
+        self.assertIs(record.capability, self.node2.peers_capabilities[id1])
+        self.assertNotIn(id1, self.node2.subscriptions)
+        self.node2.signal_subscribe(id2, "TestRecvFloat", id1, "TestEmitFloat")
+        time.sleep(0.1)
+        self.node1.run_once(0)
+        self.assertEqual({"TestEmitFloat": ["TestRecvFloat"]}, self.node2.subscriptions[id1])
+        self.assertFalse(any(record.legacy_gets for record in self.node2._peers.values()))
+        self.assertEqual({"TestEmitFloat": ["TestRecvFloat"]}, self.node1.subscribers[id2])
+        self.node1.emit_signal("TestEmitFloat", 2.0)
+        time.sleep(0.1)
+        self.node2.run_once(0)
+        self.assertEqual(1, record.signals)
+        # the views are read-only
+        with self.assertRaises(TypeError):
+            self.node2.subscriptions[id1] = {}
+    # end test_peer_records
+
     def test_peer_address(self):
         id1 = self.node1.uuid()
         id2 = self.node2.uuid()
@@ -99,12 +150,14 @@ class ZOCPTest(unittest.TestCase):
         # subscriptions structure: {Emitter nodeID: {'EmitterID': ['Local ReceiverID']}}
         self.assertIn("TestRecvFloat", self.node2.subscriptions[self.node1.uuid()]["TestEmitFloat"])
         self.assertIn("TestRecvFloat", self.node1.subscribers[self.node2.uuid()]["TestEmitFloat"])
+        self.assertEqual({self.node1._peers[self.node2.uuid().bytes]}, self.node1._get_subscribers(["TestEmitFloat"]))
         # unsubscribe
         self.node2.signal_unsubscribe(self.node2.uuid(), "TestRecvFloat", self.node1.uuid(), "TestEmitFloat")
         time.sleep(0.5)
         self.node1.run_once()
         self.assertNotIn("TestRecvFloat", self.node2.subscriptions.get(self.node1.uuid(), {}).get("TestEmitFloat", {}))
         self.assertNotIn("TestRecvFloat", self.node1.subscribers.get(self.node2.uuid(), {}).get("TestEmitFloat", {}))
+        self.assertEqual(set(), self.node1._get_subscribers(["TestEmitFloat"]))
 
     def test_self_emitter_subscribe(self):
         self.node1.register_float("TestEmitFloat", 1.0, 'rwe')
@@ -164,8 +217,681 @@ class ZOCPTest(unittest.TestCase):
         self.node2.signal_unsubscribe(self.node2.uuid(), "TestRecvFloat", self.node1.uuid(), "TestEmitFloat")
         time.sleep(0.1)
         self.node1.run_once()
+
+    def test_emit_signal_frame(self):
+        self.node1.register_vec3f("TestEmitVec", [0.0, 0.0, 0.0], 'rwe')
+        self.node2.register_vec3f("TestRecvVec", [0.0, 0.0, 0.0], 'rws')
+        self.node1.run_once(0)
+        self.node2.run_once(0)
+        self.node2.signal_subscribe(self.node2.uuid(), "TestRecvVec", self.node1.uuid(), "TestEmitVec")
+        time.sleep(0.1)
+        self.node1.run_once(0)
+        self.node1.emit_signal("TestEmitVec", [1.0, 2.0, 3.0])
+        time.sleep(0.1)
+        self.node2.run_once(0)
+        # the signal was sent as a typed frame
+        index = self.node1._sig_index["TestEmitVec"]
+        self.assertIn(index, self.node1._peers[self.node2.uuid().bytes].sig_announced)
+        self.assertEqual([1.0, 2.0, 3.0], self.node2.capability["TestRecvVec"]["value"])
+        self.assertEqual([1.0, 2.0, 3.0],
+            self.node2.peers_capabilities[self.node1.uuid()]["TestEmitVec"]["value"])
+
+    def test_emit_nested_signal(self):
+        self.node1.set_object("Lamp", "BPY_Lamp", params=[
+            {'name': "energy", 'value': 1.0, 'typeHint': 'flt', 'access': 'rwe'}])
+        self.node1.set_object()
+        self.node2.set_object("Lamp", "BPY_Lamp", params=[
+            {'name': "energy", 'value': 1.0, 'typeHint': 'flt', 'access': 'rws'}])
+        self.node2.set_object()
+        self.assertIs(self.node1.capability['objects']['Lamp']['energy'],
+                      self.node1._params["objects.Lamp.energy"])
+        self.node1.run_once(0)
+        self.node2.run_once(0)
+        self.node2.peer_get_capability(self.node1.uuid())
+        self.node2.signal_subscribe(self.node2.uuid(), "objects.Lamp.energy",
+                                    self.node1.uuid(), "objects.Lamp.energy")
+        time.sleep(0.1)
+        self.node1.run_once(0)
+        self.assertEqual([(self.node2.uuid().hex, "objects.Lamp.energy")],
+                         self.node1.capability['objects']['Lamp']['energy']['subscribers'])
+        self.node1.emit_signal("objects.Lamp.energy", 2.0)
+        time.sleep(0.1)
+        self.node2.run_once(0)
+        self.node2.run_once(0)
+        self.assertEqual(2.0, self.node2.get_value("objects.Lamp.energy"))
+        self.assertEqual(2.0, self.node2.peers_capabilities[self.node1.uuid()]
+                         ['objects']['Lamp']['energy']['value'])
+        self.assertIsInstance(self.node2.peers_capabilities[self.node1.uuid()]
+                              ['objects']['Lamp']['energy'], zocp.Parameter)
+        # a SET of the nested emitter by another peer signals the subscribers
+        self.node1._handle_SET({'objects': {'Lamp': {'energy': {'value': 3.0}}}},
+                               uuid.uuid4(), "node3", None)
+        time.sleep(0.1)
+        self.node2.run_once(0)
+        self.assertEqual(3.0, self.node2.get_value("objects.Lamp.energy"))
+
+    @unittest.skipIf(numpy is None, "numpy is not installed")
+    def test_emit_array(self):
+        self.node1.register_array("TestEmitArray", numpy.zeros(4), 'rwe')
+        self.node2.register_array("TestRecvArray", numpy.zeros(4), 'rws')
+        self.node1.run_once(0)
+        self.node2.run_once(0)
+        self.node2.signal_subscribe(self.node2.uuid(), "TestRecvArray", self.node1.uuid(), "TestEmitArray")
+        time.sleep(0.1)
+        self.node1.run_once(0)
+        data = numpy.arange(10000, dtype='float32').reshape(100, 100)
+        self.node1.emit_signal("TestEmitArray", data)
+        time.sleep(0.1)
+        self.node2.run_once(0)
+        value = self.node2.capability["TestRecvArray"]["value"]
+        self.assertIsInstance(value, numpy.ndarray)
+        self.assertEqual(data.dtype, value.dtype)
+        self.assertTrue(numpy.array_equal(data, value))
+
+    def test_emit_signals(self):
+        self.node1.register_float("TestEmitFloat1", 1.0, 'rwe')
+        self.node1.register_float("TestEmitFloat2", 1.0, 'rwe')
+        time.sleep(0.1)
+        self.node1.run_once(0)
+        self.node2.run_once(0)
+        self.node2.signal_subscribe(self.node2.uuid(), None, self.node1.uuid(), None)
+        time.sleep(0.1)
+        self.node1.run_once(0)
+        self.node2.run_once(0)
+        whispers = []
+        self.node2.on_peer_whisper = lambda peer, name, data: whispers.append(data[0])
+        self.node1.emit_signals({"TestEmitFloat1": 2.0, "TestEmitFloat2": 3.0})
+        time.sleep(0.1)
+        self.node2.run_once(0)
+        # both signals arrive in a single message
+        self.assertEqual(1, len([w for w in whispers if b'SIG' in w]))
+        capability = self.node2.peers_capabilities[self.node1.uuid()]
+        self.assertEqual(2.0, capability["TestEmitFloat1"]["value"])
+        self.assertEqual(3.0, capability["TestEmitFloat2"]["value"])
+
+    def test_emit_signal_max_rate(self):
+        self.node1.register_float("TestEmitFloat", 0.0, 'rwe', max_rate=5)
+        self.node2.register_float("TestRecvFloat", 0.0, 'rws')
+        self.node1.run_once(0)
+        self.node2.run_once(0)
+        self.node2.signal_subscribe(self.node2.uuid(), "TestRecvFloat", self.node1.uuid(), "TestEmitFloat")
+        time.sleep(0.1)
+        self.node1.run_once(0)
+        for value in range(1, 11):
+            self.node1.emit_signal("TestEmitFloat", float(value))
+        time.sleep(0.1)
+        self.node2.run_once(0)
+        # only the first value is sent within the rate window
+        self.assertEqual(1.0, self.node2.capability["TestRecvFloat"]["value"])
+        # the newest value is sent when the window closes
+        time.sleep(0.2)
+        self.node1.run_once(0)
+        time.sleep(0.1)
+        self.node2.run_once(0)
+        self.assertEqual(10.0, self.node2.capability["TestRecvFloat"]["value"])
+
+    def test_emit_signal_deadband(self):
+        self.node1.register_vec2f("TestEmitVec", [0.0, 0.0], 'rwe', deadband=0.5)
+        self.node2.register_vec2f("TestRecvVec", [0.0, 0.0], 'rws')
+        self.node1.run_once(0)
+        self.node2.run_once(0)
+        self.node2.signal_subscribe(self.node2.uuid(), "TestRecvVec", self.node1.uuid(), "TestEmitVec")
+        time.sleep(0.1)
+        self.node1.run_once(0)
+        self.node1.emit_signal("TestEmitVec", [1.0, 1.0])
+        time.sleep(0.1)
+        self.node2.run_once(0)
+        self.assertEqual([1.0, 1.0], self.node2.capability["TestRecvVec"]["value"])
+        # within the deadband the value is only updated locally
+        self.node1.emit_signal("TestEmitVec", [1.2, 1.4])
+        time.sleep(0.1)
+        self.node2.run_once(0)
+        self.assertEqual([1.2, 1.4], self.node1.get_value("TestEmitVec"))
+        self.assertEqual([1.0, 1.0], self.node2.capability["TestRecvVec"]["value"])
+        # a single component outside the deadband sends the value
+        self.node1.emit_signal("TestEmitVec", [1.2, 1.6])
+        time.sleep(0.1)
+        self.node2.run_once(0)
+        self.assertEqual([1.2, 1.6], self.node2.capability["TestRecvVec"]["value"])
+
+    def test_emit_signal_deadband_max_rate(self):
+        self.node1.register_float("TestEmitFloat", 0.0, 'rwe', max_rate=10, deadband=1.0)
+        sent = []
+        self.node1._whisper_signal = lambda peers, emitter, value: sent.append(value)
+        for value in (0.0, 5.0, 4.5):
+            self.node1.emit_signal("TestEmitFloat", value)
+        time.sleep(0.15)
+        self.node1.run_once(0)
+        self.assertEqual([0.0, 4.5], sent)
+        # the deadband applies to the value actually sent last
+        time.sleep(0.15)
+        self.node1.emit_signal("TestEmitFloat", 5.9)
+        self.assertEqual([0.0, 4.5, 5.9], sent)
+        del self.node1._whisper_signal
+
+    def test_method_handlers(self):
+        node3 = HookNode("node3")
+        node3.start()
+        try:
+            time.sleep(1)
+            node3.run_once(0)
+            self.node1.run_once(0)
+            # unknown methods are ignored, handle_<METHOD> hooks are called
+            self.node1.whisper(node3.uuid(), b'{"UNKNOWN": 1}')
+            self.node1.whisper(node3.uuid(), b'{"PING": 2}')
+            time.sleep(0.1)
+            node3.run_once(0)
+            self.assertEqual([2], node3.pings)
+        finally:
+            node3.stop()
+
+    def test_peer_requests(self):
+        import concurrent.futures
+        self.node2.register_float("TestFloat", 1.0, 'rw')
+        self.node1.run_once(0)
+        self.node2.run_once(0)
+        peer = self.node2.uuid()
+        results = []
+        get = self.node1.peer_get(peer, ["TestFloat"], callback=results.append)
+        setf = self.node1.peer_set(peer, {"TestFloat": {"value": 2.0}})
+        # a SET the peer fails to handle is reported back
+        bad = self.node1.peer_set(peer, ["TestFloat"])
+        end = time.time() + 2
+        while not (get.done() and setf.done() and bad.done()) and time.time() < end:
+            self.node2.run_once(10)
+            self.node1.run_once(10)
+        self.assertEqual(1.0, get.result()["TestFloat"]["value"])
+        self.assertEqual([get], results)
+        self.assertIsNone(setf.result())
+        self.assertEqual(2.0, self.node2.capability["TestFloat"]["value"])
+        self.assertRaises(zocp.ZOCPRequestError, bad.result)
+        # a request the peer doesn't answer in time fails
+        late = self.node1.peer_get(peer, ["TestFloat"], timeout=0.05)
+        end = time.time() + 0.2
+        while time.time() < end:
+            self.node1.run_once(10)
+        self.assertRaises(concurrent.futures.TimeoutError, late.result, 0)
+        # also when the peer doesn't support requests
+        legacy = self.node1.peer_get(uuid.uuid4(), ["TestFloat"], timeout=0.05)
+        end = time.time() + 0.2
+        while time.time() < end:
+            self.node1.run_once(10)
+        self.assertRaises(concurrent.futures.TimeoutError, legacy.result, 0)
+        self.assertFalse(any(record.legacy_gets for record in self.node1._peers.values()))
+        # such peers echo the keys of a GET as a SET before the MOD
+        old = uuid.uuid4()
+        legacy = self.node1.peer_get(old, ["TestFloat"])
+        self.node1._handle_SET(["TestFloat"], old, "old", None)
+        self.node1._handle_MOD({"TestFloat": {"value": 3.0}}, old, "old", None)
+        self.assertEqual({"TestFloat": {"value": 3.0}}, legacy.result(0))
+        self.assertNotIn("TestFloat", self.node1.capability)
+
+    def test_peer_call(self):
+        import concurrent.futures
+        executor = concurrent.futures.ThreadPoolExecutor(1)
+        self.node2.executor = executor
+        def slow_add(a, b):
+            time.sleep(0.3)
+            return a + b
+        self.node2.register_method("add", lambda a, b: a + b, executor=False)
+        self.node2.register_method("slowAdd", slow_add)
+        self.node2.register_method("pair", lambda: {1, 2}, executor=False)
+        self.node2.register_method("slowPair", lambda: {1, 2})
+        self.assertEqual('method', self.node2.capability["slowAdd"]["typeHint"])
+        self.node1.run_once(0)
+        self.node2.run_once(0)
+        peer = self.node2.uuid()
+        try:
+            slow = self.node1.peer_call(peer, "slowAdd", 1, 2)
+            fast = self.node1.peer_call(peer, "add", 3, 4)
+            unknown = self.node1.peer_call(peer, "unknown")
+            end = time.time() + 2
+            while not fast.done() and time.time() < end:
+                self.node2.run_once(10)
+                self.node1.run_once(10)
+            # the slow call doesn't hold up the loop
+            self.assertEqual(7, fast.result(0))
+            self.assertFalse(slow.done())
+            while not (slow.done() and unknown.done()) and time.time() < end:
+                self.node2.run_once(10)
+                self.node1.run_once(10)
+            self.assertEqual(3, slow.result(0))
+            self.assertRaises(zocp.ZOCPRequestError, unknown.result, 0)
+            # results which can't be encoded are reported as errors
+            pair = self.node1.peer_call(peer, "pair")
+            slow_pair = self.node1.peer_call(peer, "slowPair")
+            while not (pair.done() and slow_pair.done()) and time.time() < end:
+                self.node2.run_once(10)
+                self.node1.run_once(10)
+            self.assertRaises(zocp.ZOCPRequestError, pair.result, 0)
+            self.assertRaises(zocp.ZOCPRequestError, slow_pair.result, 0)
+        finally:
+            executor.shutdown()
+
+    def test_node_group(self):
+        group = zocp.NodeGroup([self.node1, self.node2], max_messages=2)
+        time.sleep(0.1)
+        group.run_once(0)
+        for i in range(5):
+            self.node1.whisper(self.node2.uuid(), b'{"PING": 1}')
+            self.node2.whisper(self.node1.uuid(), b'{"PING": 2}')
+        calls = []
+        self.node1.call_later(0.05, calls.append, "later")
+        time.sleep(0.1)
+        whispers = []
+        self.node1.on_peer_whisper = lambda peer, name, data: whispers.append(data[0])
+        self.node2.on_peer_whisper = lambda peer, name, data: whispers.append(data[0])
+        # both nodes get a turn with a limited amount of messages
+        self.assertTrue(group.run_once(0))
+        self.assertIn(whispers.count(b'{"PING": 1}'), (1, 2))
+        self.assertIn(whispers.count(b'{"PING": 2}'), (1, 2))
+        self.assertEqual(["later"], calls)
+        end = time.time() + 1
+        while group.run_once(0) and time.time() < end:
+            pass
+        self.assertEqual(10, len([w for w in whispers if w.startswith(b'{"PING"')]))
+
+    def test_capability_cache(self):
+        self.node2.register_float("TestFloat", 1.0, 'rwe')
+        self.node1.run_once(0)
+        self.node2.run_once(0)
+        peer = self.node2.uuid()
+        gets = [self.node1.peer_get_capability(peer) for i in range(3)]
+        end = time.time() + 2
+        while not all(get.done() for get in gets) and time.time() < end:
+            self.node2.run_once(10)
+            self.node1.run_once(10)
+        self.assertEqual(1.0, gets[2].result(0)["TestFloat"]["value"])
+        self.assertEqual(1, len(self.node2._capability_cache))
+        # modifications invalidate the cached capability
+        self.node2.emit_signal("TestFloat", 2.0)
+        self.assertEqual({}, self.node2._capability_cache)
+        get = self.node1.peer_get_capability(peer)
+        end = time.time() + 2
+        while not get.done() and time.time() < end:
+            self.node2.run_once(10)
+            self.node1.run_once(10)
+        self.assertEqual(2.0, get.result(0)["TestFloat"]["value"])
+
+    def test_capability_cache_lru(self):
+        import shutil
+        import tempfile
+        node = self.node1
+        node.capability_cache_size = 2
+        node._peer_cap_dir = tempfile.mkdtemp()
+        try:
+            caps = [{"TestFloat": {"value": float(i)}} for i in range(3)]
+            hashes = [zocp.canonical_capability(cap)[1] for cap in caps]
+            node._cache_capability(caps[0])
+            node._cache_capability(caps[1])
+            # a hit makes a capability the most recently used
+            self.assertEqual(caps[0], node._get_cached_capability(hashes[0]))
+            node._cache_capability(caps[2])
+            self.assertEqual([hashes[0], hashes[2]], list(node._peer_cap_store))
+            # loading from disk keeps the size
+            self.assertEqual(caps[1], node._get_cached_capability(hashes[1]))
+            self.assertEqual([hashes[2], hashes[1]], list(node._peer_cap_store))
+        finally:
+            shutil.rmtree(node._peer_cap_dir)
+
+    def test_capability_hash(self):
+        self.node2.register_float("TestFloat", 1.0, 'rw')
+        time.sleep(1.1)
+        self.node2.run_once(0)
+        caphash = zocp.canonical_capability(self.node2.capability)[1]
+        # a peer which has seen the capability before doesn't GET it
+        node3 = zocp.ZOCP("node3")
+        node3._cache_capability(self.node2.capability)
+        gets = []
+        node3.peer_get_capability = gets.append
+        node3.start()
+        try:
+            time.sleep(1)
+            node3.run_once(0)
+            self.assertEqual(caphash, node3.peer_header_value(self.node2.uuid(), "X-ZOCP-CAPHASH"))
+            self.assertNotIn(self.node2.uuid(), gets)
+            self.assertEqual(1.0, node3.peers_capabilities[self.node2.uuid()]["TestFloat"]["value"])
+        finally:
+            node3.stop()
+        # until the hash of a modified capability is advertised peers GET it
+        node4 = zocp.ZOCP("node4")
+        node4._cache_capability(self.node2.capability)
+        self.node2.emit_signal("TestFloat", 2.0)
+        node4.start()
+        try:
+            end = time.time() + 3
+            while time.time() < end and node4.peers_capabilities.get(self.node2.uuid(), {}).get("TestFloat") is None:
+                self.node2.run_once(10)
+                node4.run_once(10)
+            self.assertEqual(2.0, node4.peers_capabilities[self.node2.uuid()]["TestFloat"]["value"])
+        finally:
+            node4.stop()
+
+    def test_capability_versions(self):
+        self.node1.register_float("TestRecvFloat", 1.0, 'rws')
+        self.node2.register_float("TestEmitFloat", 1.0, 'rwe')
+        self.node2.register_float("TestOther", 1.0, 'rw')
+        time.sleep(0.1)
+        self.node1.run_once(0)
+        self.node2.run_once(0)
+        peer = self.node2.uuid()
+        self.node1.signal_subscribe(self.node1.uuid(), "TestRecvFloat", peer, None)
+        time.sleep(0.3)
+        self.node2.run_once(0)
+        time.sleep(0.1)
+        self.node1.run_once(0)
+        self.node2._on_modified({"TestOther": {"min": 0.0}})
+        time.sleep(0.1)
+        self.node1.run_once(0)
+        self.assertEqual(self.node2._version, self.node1._peers[peer.bytes].version)
+        # a MOD which got lost is fetched with SINCE
+        self.node2.whisper = lambda peer, msg: None
+        self.node2._on_modified({"TestOther": {"max": 5.0}})
+        del self.node2.whisper
+        self.node2._on_modified({"TestOther": {"step": 0.5}})
+        end = time.time() + 1
+        while self.node1._peers[peer.bytes].version != self.node2._version or \
+                "max" not in self.node1.peers_capabilities[peer]["TestOther"]:
+            self.node1.run_once(10)
+            self.node2.run_once(10)
+            self.assertLess(time.time(), end)
+        self.assertEqual(5.0, self.node1.peers_capabilities[peer]["TestOther"]["max"])
+        self.assertEqual(0.5, self.node1.peers_capabilities[peer]["TestOther"]["step"])
+
+    def test_compression(self):
+        self.node2.compress_threshold = 200
+        for i in range(50):
+            self.node2.register_float("TestFloat%d" % i, float(i), 'rwe')
+        self.node1.run_once(0)
+        self.node2.run_once(0)
+        sent = []
+        whisper = zocp.ZOCP.whisper
+        self.node2.whisper = lambda peer, msg: (sent.append(msg), whisper(self.node2, peer, msg))
+        try:
+            get = self.node1.peer_get_capability(self.node2.uuid())
+            end = time.time() + 2
+            while not get.done() and time.time() < end:
+                self.node2.run_once(10)
+                self.node1.run_once(10)
+            self.assertEqual(49.0, get.result(0)["TestFloat49"]["value"])
+            self.assertEqual(zocp.ZLIB_FRAME_MARKER, sent[-1][:1])
+            self.assertLess(len(sent[-1]), len(self.node2._encoded_capability(self.node2.codecs[0])) / 4)
+            # small messages are never compressed
+            self.node2.peer_get(self.node1.uuid(), ["TestFloat0"])
+            self.assertNotEqual(zocp.ZLIB_FRAME_MARKER, sent[-1][:1])
+        finally:
+            del self.node2.whisper
+
+    def test_register_params(self):
+        version = self.node1._version
+        self.node1.set_object("Lamp", "BPY_Lamp", params=[
+            {'name': "energy", 'value': 1.0, 'typeHint': 'flt', 'access': 'rw'},
+            {'name': "color", 'value': [1.0, 0.5, 0.0], 'typeHint': 'vec3f', 'access': 're', 'max': 1.0},
+        ])
+        self.node1.set_object()
+        self.node1.register_params({"TestInt": {'value': 2, 'typeHint': 'int'}})
+        # one modification per bulk registration
+        self.assertEqual(version + 2, self.node1._version)
+        lamp = self.node1.capability['objects']['Lamp']
+        self.assertEqual('BPY_Lamp', lamp['type'])
+        self.assertEqual(1.0, lamp['color']['max'])
+        self.assertEqual('rw', lamp['energy']['access'])
+        self.assertEqual({'value': 2, 'typeHint': 'int', 'access': 'r', 'subscribers': []},
+                         self.node1.capability['TestInt'])
+        self.assertEqual({'objects': {'Lamp': lamp}},
+                         zocp.json_codec.decode(self.node1._delta_log[-2][1]))
+
+    def test_delta_log(self):
+        self.node1.delta_log_bytes = 200
+        for i in range(10):
+            self.node1.register_float("TestFloat%d" % i, 1.0)
+        # the log is limited by the size of the encoded modifications
+        self.assertLess(len(self.node1._delta_log), 10)
+        self.assertEqual(self.node1._version, self.node1._delta_log[-1][0])
+        self.assertEqual(sum(len(delta) for version, delta in self.node1._delta_log),
+                         self.node1._delta_log_used)
+        # a complete capability replaces the logged modifications
+        self.node1.set_capability(self.node1.capability)
+        self.assertEqual(0, len(self.node1._delta_log))
+
+    def test_batch(self):
+        self.node1.register_float("TestFloat", 1.0, 'rwe')
+        self.node1.register_float("TestOther", 1.0, 'rwe')
+        modified = []
+        self.node1.on_modified = lambda peer, name, data: modified.append(data)
+        version = self.node1._version
+        with self.node1.batch():
+            self.node1.set_node_location([1, 2, 3])
+            with self.node1.batch():
+                self.node1.set_node_orientation([0, 90, 0])
+            self.assertEqual([], modified)
+        self.assertEqual([{'_location': [1, 2, 3], '_orientation': [0, 90, 0]}], modified)
+        self.assertEqual(version + 1, self.node1._version)
+        # signals in a batch are sent together
+        sent = []
+        self.node1._whisper_signals = lambda signals, exclude=None: sent.append(dict(signals))
+        with self.node1.batch():
+            self.node1.emit_signal("TestFloat", 2.0)
+            self.node1.emit_signal("TestOther", 3.0)
+            self.node1.emit_signal("TestFloat", 4.0)
+            self.assertEqual([], sent)
+        del self.node1._whisper_signals
+        self.assertEqual([{"TestFloat": 4.0, "TestOther": 3.0}], sent)
+        self.assertEqual(4.0, self.node1.capability["TestFloat"]["value"])
+
+    def test_set_no_change(self):
+        self.node2.register_float("TestFloat", 1.0, 'rw')
+        self.node1.run_once(0)
+        self.node2.run_once(0)
+        modified = []
+        self.node2.on_modified = lambda peer, name, data: modified.append(data)
+        peer = self.node2.uuid()
+        sets = [self.node1.peer_set(peer, {"TestFloat": {"value": 1.0, "access": "rw"}}),
+                self.node1.peer_set(peer, {"TestFloat": {"value": 2.0, "access": "rw"}})]
+        end = time.time() + 2
+        while not all(f.done() for f in sets) and time.time() < end:
+            self.node2.run_once(10)
+            self.node1.run_once(10)
+        # only the effective change is published
+        self.assertEqual([{"TestFloat": {"value": 2.0}}], modified)
+
+    def test_timers(self):
+        calls = []
+        self.node1.call_later(0.05, calls.append, "later")
+        timer = self.node1.call_every(0.02, calls.append, "every")
+        self.node1.call_later(0.01, calls.append, "cancelled").cancel()
+        end = time.time() + 0.11
+        while time.time() < end:
+            self.node1.run_once(100)
+        timer.cancel()
+        self.node1.run_once(30)
+        self.assertEqual(1, calls.count("later"))
+        self.assertNotIn("cancelled", calls)
+        self.assertTrue(4 <= calls.count("every") <= 6)
+
+    def test_run_once_budget(self):
+        time.sleep(0.1)
+        self.node1.run_once(0)
+        self.node2.run_once(0)
+        for i in range(5):
+            self.node1.whisper(self.node2.uuid(), b'{"PING": 1}')
+        time.sleep(0.1)
+        whispers = []
+        self.node2.on_peer_whisper = lambda peer, name, data: whispers.append(data)
+        self.assertTrue(self.node2.run_once(0, max_messages=2))
+        self.assertEqual(2, len(whispers))
+        self.assertFalse(self.node2.run_once(0, max_messages=10))
+        self.assertEqual(5, len([w for w in whispers if w[0] == b'{"PING": 1}']))
+
+    def test_codec_negotiation(self):
+        # both nodes speak the same codecs so the most preferred is used
+        self.node1.run_once(0)
+        codec = self.node1._peers[self.node2.uuid().bytes].codec
+        self.assertEqual(self.node1.codecs[0].name, codec.name)
+        # a node only speaking JSON forces its peers to use JSON
+        node3 = zocp.ZOCP("node3", codecs=[zocp.JSONCodec()])
+        node3.register_float("TestRecvFloat", 1.0, 'rws')
+        node3.start()
+        try:
+            self.node1.register_float("TestEmitFloat", 1.0, 'rwe')
+            time.sleep(1)
+            self.node1.run_once(0)
+            node3.run_once(0)
+            self.assertEqual("json", self.node1._peers[node3.uuid().bytes].codec.name)
+            node3.signal_subscribe(node3.uuid(), "TestRecvFloat", self.node1.uuid(), "TestEmitFloat")
+            time.sleep(0.1)
+            self.node1.run_once(0)
+            self.node1.emit_signal("TestEmitFloat", 3.0)
+            time.sleep(0.1)
+            node3.run_once(0)
+            self.assertEqual(3.0, node3.capability["TestRecvFloat"]["value"])
+        finally:
+            node3.stop()
 # end ZOCPTest
 
+
+class CodecTest(unittest.TestCase):
+
+    def test_roundtrip(self):
+        data = {'MOD': {'TestFloat': {'value': 1.5, 'typeHint': 'flt',
+                                      'access': 'rw', 'subscribers': []}}}
+        for codec in (zocp.JSONCodec(), zocp.MsgPackCodec()):
+            if not codec.available:
+                continue
+            payload = codec.encode(data)
+            self.assertEqual(codec.marker, payload[:1])
+            self.assertEqual(data, codec.decode(payload))
+            raw = codec.encode_value(data['MOD'])
+            self.assertEqual(data, codec.decode(codec.encode_raw('MOD', raw)))
+            self.assertEqual({'REP': [3, data['MOD']]},
+                             codec.decode(codec.encode_raw('REP', raw, [3])))
+            self.assertEqual({'REP': [data['MOD']]},
+                             codec.decode(codec.encode_raw('REP', raw, [])))
+            self.assertEqual({'VER': [2, None], 'MOD': data['MOD']},
+                             codec.decode(codec.encode_raw('MOD', raw, extra={'VER': [2, None]})))
+# end CodecTest
+
+class DictMergeTest(unittest.TestCase):
+
+    def test_merge_diff(self):
+        a = {'x': {'value': 1, 'min': 0}, 'y': {'value': [1, 2]}, 'z': 1}
+        b = {'x': {'value': 1, 'min': 1}, 'y': {'value': [1, 2]}, 'w': {'value': 3}}
+        merged, diff = zocp.dict_merge_diff(a, b)
+        self.assertIs(a, merged)
+        self.assertEqual({'x': {'min': 1}, 'w': {'value': 3}}, diff)
+        self.assertEqual({'x': {'value': 1, 'min': 1}, 'y': {'value': [1, 2]},
+                          'z': 1, 'w': {'value': 3}}, a)
+        self.assertEqual({}, zocp.dict_merge_diff(a, b)[1])
+        self.assertEqual((b, b), zocp.dict_merge_diff(None, b))
+        self.assertEqual({'x': {'value': 1, 'min': 2}, 'y': {'value': [1, 2]},
+                          'z': 1, 'w': {'value': 3}},
+                         zocp.dict_merge(a, {'x': {'min': 2}}))
+
+    def test_parameter(self):
+        spec = {'value': 1.0, 'typeHint': 'flt', 'access': 'rw', 'subscribers': [], 'unit': 'lm'}
+        param = zocp.Parameter(spec)
+        self.assertEqual(spec, param)
+        self.assertEqual(spec, param.to_dict())
+        self.assertIsNone(param.get('max'))
+        self.assertNotIn('max', param)
+        self.assertIs(zocp.intern('flt'), param.typeHint)
+        # values are merged into parameters, other keys are kept
+        tree = {'objects': {'Lamp': {'energy': param}}}
+        merged, diff = zocp.dict_merge_diff(tree, {'objects': {'Lamp': {'energy': {'value': 2.0, 'max': 5.0}}}})
+        self.assertIs(param, merged['objects']['Lamp']['energy'])
+        self.assertEqual(2.0, param.value)
+        self.assertEqual(5.0, param.max)
+        self.assertEqual({'objects': {'Lamp': {'energy': {'value': 2.0, 'max': 5.0}}}}, diff)
+        self.assertEqual(json.loads(zocp.json_codec.encode(tree).decode('utf-8')), tree)
+        # dicts in a capability tree become parameters when indexed
+        index = zocp.param_index({'x': {'value': 1, 'typeHint': 'int'}, 'objects': tree['objects']})
+        self.assertEqual({'x', 'objects.Lamp.energy'}, set(index))
+        self.assertIsInstance(index['x'], zocp.Parameter)
+# end DictMergeTest
+
+@unittest.skipIf(AsyncZOCP is None, "asyncio not available")
+class AsyncZOCPTest(unittest.TestCase):
+
+    def test_peer_requests(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        ctx = zmq.Context()
+        node1 = AsyncZOCP("node1", ctx=ctx)
+        node2 = AsyncZOCP("node2", ctx=ctx)
+        node2.register_float("TestFloat", 1.0, 'rw')
+        node1.register_float("TestRecv", 0.0, 'rw')
+
+        # no async def, this module must still parse on Python 2
+        run = loop.run_until_complete
+        try:
+            loop.call_soon(node1.start_async)
+            loop.call_soon(node2.start_async)
+            run(asyncio.sleep(1))
+            peer = node2.uuid()
+            cap = run(node1.peer_get_async(peer, timeout=5))
+            self.assertEqual(1.0, cap['TestFloat']['value'])
+            cap = run(node1.peer_set_async(peer, {'TestFloat': {'value': 2.0}}, timeout=5))
+            self.assertEqual(2.0, cap['TestFloat']['value'])
+            self.assertEqual(2.0, node2.capability['TestFloat']['value'])
+            emitter = run(node1.signal_subscribe_async(node1.uuid(), "TestRecv", peer, "TestFloat", timeout=5))
+            self.assertIn([node1.uuid().hex, "TestRecv"], emitter['subscribers'])
+            # an unanswered request is dropped when it times out
+            node2._handle_request = lambda *args: None
+            with self.assertRaises(asyncio.TimeoutError):
+                run(node1.peer_get_async(peer, timeout=0.2))
+            del node2._handle_request
+            self.assertEqual({}, node1._requests)
+        finally:
+            node1.stop()
+            node2.stop()
+            loop.run_until_complete(asyncio.sleep(0))
+            loop.close()
+# end AsyncZOCPTest
+
+class ThreadedZOCPTest(unittest.TestCase):
+
+    def test_events_and_signals(self):
+        import select
+        import threading
+        node1 = ThreadedZOCP("node1")
+        node2 = ThreadedZOCP("node2")
+        node1.register_float("TestEmitFloat", 1.0, 'rwe')
+        node2.register_float("TestRecvFloat", 1.0, 'rws')
+        threads = set()
+        node2.on_peer_signaled = lambda peer, name, data, *args: threads.add(threading.current_thread())
+        node1.start()
+        node2.start()
+        try:
+            time.sleep(1)
+            # queries of the peers are answered through the I/O thread
+            self.assertIn(node1.uuid(), node2.peers())
+            self.assertIsInstance(node2.peer_address(node1.uuid()), unicode)
+            node2.set_node_location([1, 2, 3])
+            # requests can be waited on from the application thread
+            cap = node2.peer_get(node1.uuid(), ["TestEmitFloat"]).result(2)
+            self.assertEqual(1.0, cap["TestEmitFloat"]["value"])
+            node2.signal_subscribe(node2.uuid(), "TestRecvFloat", node1.uuid(), "TestEmitFloat")
+            time.sleep(0.5)
+            node1.emit_signal("TestEmitFloat", 2.0)
+            end = time.time() + 2
+            while node2.capability["TestRecvFloat"]["value"] != 2.0 and time.time() < end:
+                select.select([node2.fileno()], [], [], 0.1)
+                node2.process_events()
+            self.assertEqual(2.0, node2.capability["TestRecvFloat"]["value"])
+            node2.process_events()
+            # events are only delivered in process_events
+            self.assertEqual({threading.current_thread()}, threads)
+            # a message failing to be handled doesn't stop the I/O thread
+            node2.signal_subscribe(node2.uuid(), "TestRecvFloat", node1.uuid(), "Nope")
+            time.sleep(0.5)
+            self.assertTrue(node1._thread.is_alive())
+            cap = node2.peer_get(node1.uuid(), ["TestEmitFloat"]).result(2)
+            self.assertEqual(2.0, cap["TestEmitFloat"]["value"])
+        finally:
+            node1.stop()
+            node2.stop()
+# end ThreadedZOCPTest
+
 if __name__ == '__main__':
     import logging
     logger = logging.getLogger("zocp")